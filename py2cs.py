@@ -21,23 +21,52 @@ Hosted at: https://github.com/edreamleo/python-to-coffeescript
 # 
 # **THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.**
 import ast
+import cProfile
+import difflib
+import fnmatch
 import glob
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.util
 import optparse
 import os
+import pickle
+import pstats
+import re
+import subprocess
 import sys
+import tarfile
+import threading
 import time
 import token as token_module
 import tokenize
 import types
+import xml.etree.ElementTree as ElementTree
+import zipfile
 try:
     import ConfigParser as configparser # Python 2
 except ImportError:
     import configparser # Python 3
+try:
+    import Queue as queue # Python 2
+except ImportError:
+    import queue # Python 3
 try:
     import StringIO as io # Python 2
 except ImportError:
     import io # Python 3
 isPython3 = sys.version_info >= (3, 0, 0)
+# time.clock does not exist in Python 3.8 and above.
+clock = getattr(time, 'perf_counter', None) or time.clock
+# os.rename fails on Windows if the target exists.
+replace_file = getattr(os, 'replace', os.rename)
+# The levels of --log-level.
+log_levels = {'error': 1, 'warning': 2, 'info': 3, 'debug': 4}
+# The profiler of a worker process.
+worker_profiler = None
+# The sha1 of this script, computed by script_sha1.
+script_sha1_value = None
 
 def main():
     '''
@@ -50,11 +79,38 @@ def main():
     controller.scan_options()
     controller.run()
     print('done')
+    if controller.exit_status:
+        sys.exit(controller.exit_status)
 
 #
 # Utility functions...
 #
 
+def convert_in_worker(conn, options):
+    '''
+    The main loop of the worker process that converts files for a
+    controller with per-file budgets. options is a dict of controller ivars.
+    Each request also sets the ivars of the current job.
+    '''
+    controller = MakeCoffeeScriptController()
+    for key, value in options.items():
+        setattr(controller, key, value)
+    while True:
+        data = conn.recv()
+        if data is None:
+            break
+        fn, s, job_options = data
+        for key, value in job_options.items():
+            setattr(controller, key, value)
+        # The parent reports the sync warnings of each file.
+        controller.sync_warnings = warnings = []
+        try:
+            result = profile_in_worker(controller.profile_fn, controller.convert, fn, s)
+            conn.send((True, result, warnings))
+        except Exception as e:
+            line, col = controller.error_location(e, sys.exc_info()[2])
+            conn.send((False, ('%s: %s' % (e.__class__.__name__, e), line, col), warnings))
+
 def dump(title, s=None):
     if s:
         print('===== %s...\n%s\n' % (title, s.rstrip()))
@@ -75,6 +131,42 @@ def dump_list(title, aList):
         print(z)
     print('')
 
+def format_chunk(data):
+    '''
+    Convert a chunk of a module's top-level statements in a worker process.
+    data is a (fn, s, flags, strip_comments, front_end_cache, profile_fn)
+    tuple, where flags are the module's future flags. Profile the
+    conversion if profile_fn is not None. Return the result of
+    format_statements and the list of the chunk's sync warnings.
+    '''
+    fn, s, flags, strip_comments, front_end_cache, profile_fn = data
+    if profile_fn:
+        return profile_in_worker(profile_fn, format_chunk,
+            (fn, s, flags, strip_comments, front_end_cache, None))
+    controller = MakeCoffeeScriptController()
+    controller.front_end_cache = front_end_cache
+    controller.sync_warnings = []
+    tokens = controller.tokenize_source(s)
+    node = compile(s, fn, 'exec', ast.PyCF_ONLY_AST | flags, True)
+    traverser = CoffeeScriptTraverser(controller=controller, strip_comments=strip_comments)
+    return traverser.format_statements(node, s, tokens) + (controller.sync_warnings,)
+
+def profile_in_worker(profile_fn, f, *args):
+    '''
+    Return f(*args). If profile_fn is not None, profile the call. The
+    statistics of all calls in this process are written to
+    profile_fn.worker-PID when the process exits.
+    '''
+    global worker_profiler
+    if not profile_fn:
+        return f(*args)
+    if not worker_profiler:
+        worker_profiler = cProfile.Profile()
+        fn = '%s.worker-%s' % (profile_fn, os.getpid())
+        multiprocessing.util.Finalize(None, worker_profiler.dump_stats,
+            args=(fn,), exitpriority=10)
+    return worker_profiler.runcall(f, *args)
+
 def op_name(node,strict=True):
     '''Return the print name of an operator node.'''
     d = {
@@ -132,19 +224,45 @@ def pdb(self):
         import pdb
         pdb.set_trace()
 
+def string_sha1(s):
+    '''Return the sha1 hex digest of string s.'''
+    if isPython3 or g.isUnicode(s):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+def script_sha1():
+    '''
+    Return the sha1 of this script's source. Caches include it in their
+    versions, so that a new version of py2cs.py ignores old results.
+    '''
+    global script_sha1_value
+    if script_sha1_value is None:
+        fn = os.path.abspath(__file__)
+        if fn.endswith(('.pyc', '.pyo')):
+            fn = fn[: -1]
+        f = open(fn, 'rb')
+        script_sha1_value = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+    return script_sha1_value
+
 def truncate(s, n):
     '''Return s truncated to n characters.'''
     return s if len(s) <= n else s[:n-3] + '...'
 
 
 class CoffeeScriptTraverser(object):
-    '''A class to convert python sources to coffeescript sources.'''
+    '''
+    A class to convert python sources to coffeescript sources.
+    All per-file state lives in the traverser and its TokenSync, so
+    traversers of different files may run in different threads.
+    '''
     # pylint: disable=consider-using-enumerate
 
-    def __init__(self, controller):
+    def __init__(self, controller, strip_comments=False):
         '''Ctor for CoffeeScriptFormatter class.'''
         self.controller = controller
         self.class_stack = []
+        self.strip_comments = strip_comments
         # Redirection. Set in format.
         self.sync_string = None
         self.last_node = None
@@ -155,10 +273,223 @@ class CoffeeScriptTraverser(object):
         self.trailing_comment_at_lineno = None
         
 
-    def format(self, node, s, tokens):
-        '''Format the node (or list of nodes) and its descendants.'''
+    def format(self, node, s, tokens, cache=None):
+        '''
+        Format the node (or list of nodes) and its descendants.
+        If cache is a dict, reuse the output of unchanged statements.
+        '''
+        sync = self.init_sync(s, tokens)
+        # Compute the result.
+        if cache is not None and isinstance(node, ast.Module):
+            val = self.format_units(node, s, cache)
+        else:
+            val = self.visit(node)
+        sync.check_strings()
+        # if isinstance(val, list): # testing:
+            # val = ' '.join(val)
+        val += ''.join(sync.trailing_lines())
+        return val or ''
+
+    def format_only(self, node, s, names):
+        '''
+        Format only the classes and functions of the Module node whose
+        qualified names, such as 'Class.method', appear in names. Return
+        (result, missing), where missing lists the names not found.
+
+        With Python 3.8 and above, only the lines of the selected nodes are
+        tokenized, and nothing else is traversed.
+        '''
+        found = self.find_definitions(node, names)
+        missing = [z for z in names if z not in [y[0] for y in found]]
+        lines = g.splitLines(s)
+        sync = None
+        result = []
+        for name, class_names, z in found:
+            linenos = [z.lineno] + [y.lineno for y in z.decorator_list]
+            start = min(linenos) - 1
+            end = getattr(z, 'end_lineno', None)
+            if end:
+                s2 = ''.join(lines[start:end])
+                tokens = self.tokenize_source(s2)
+                ast.increment_lineno(z, -start)
+                try:
+                    sync = self.init_sync(s2, tokens)
+                    self.class_stack = class_names
+                    result.append(self.visit(z))
+                    sync.check_strings()
+                    result.append(''.join(sync.trailing_lines()))
+                finally:
+                    ast.increment_lineno(z, start)
+            else:
+                # Tokenize the entire file, but traverse only the node.
+                if not sync:
+                    sync = self.init_sync(s, self.tokenize_source(s))
+                sync.first_leading_line = start
+                self.level = 0
+                self.class_stack = class_names
+                result.append(self.visit(z))
+        self.class_stack = []
+        return ''.join(result), missing
+
+    def tokenize_source(self, s):
+        '''Return the tokens of s, using the controller's front-end cache.'''
+        if self.controller:
+            return self.controller.tokenize_source(s)
+        readlines = g.ReadLinesClass(s).next
+        return list(tokenize.generate_tokens(readlines))
+
+    def find_definitions(self, node, names):
+        '''
+        Return a list of (name, class_names, node) tuples for all ClassDef and
+        FunctionDef nodes whose qualified names are in names, in source order.
+        class_names is the list of the names of the enclosing classes.
+        Definitions within selected definitions are not included.
+        '''
+        result = []
+
+        def find(body, prefix, class_names):
+            for z in body:
+                if isinstance(z, (ast.ClassDef, ast.FunctionDef)):
+                    name = prefix + z.name
+                    if name in names:
+                        result.append((name, class_names, z))
+                    elif isinstance(z, ast.ClassDef):
+                        find(z.body, name + '.', class_names + [z.name])
+                    else:
+                        find(z.body, name + '.', [])
+
+        find(node.body, '', [])
+        return result
+
+    def format_statements(self, node, s, tokens):
+        '''
+        Format the top-level statements of a Module that is one chunk of a
+        larger module. Return (head, body, tail, consumed), where:
+
+        consumed: True if any statement consumed leading lines.
+        head:     the output of statements preceding the first such statement.
+        body:     the output of all other statements.
+        tail:     the ignored lines following the last consumed line.
+
+        The caller must insert the ignored lines left over by the previous
+        chunk between head and body.
+        '''
+        sync = self.init_sync(s, tokens)
+        sync.first_leading_line = 0
+        head, body = [], []
+        for z in node.body:
+            val = self.visit(z)
+            if body or sync.first_leading_line > 0:
+                body.append(val)
+            else:
+                head.append(val)
+        sync.check_strings()
+        tail = ''.join(sync.trailing_lines())
+        return ''.join(head), ''.join(body), tail, bool(body)
+
+    def format_units(self, node, s, cache):
+        '''
+        Format a Module one statement at a time, reusing the cached output of
+        all statements whose source lines, preceding ignored lines and context
+        are unchanged. The methods of top-level classes are separate units.
+
+        cache is a dict. On exit it contains only the entries for this source.
+        '''
+        sync = self.sync
+        lines = g.splitLines(s)
+        units = self.make_units(node)
+        starts = [z[0] for z in units] + [len(lines)]
+        result, used, hits = [], {}, 0
+        for i, (start, level, class_name, nodes) in enumerate(units):
+            end = starts[i+1]
+            key = self.unit_key(lines[start:end], start, level, class_name)
+            data = cache.get(key)
+            if data:
+                hits += 1
+                val, n = data
+                # The cached statement consumes its own strings.
+                for j in range(start, end):
+                    sync.string_tokens[j] = []
+            else:
+                first = sync.first_leading_line
+                self.level = level
+                self.class_stack = [class_name] if class_name else []
+                if level == 0 and class_name:
+                    val = self.class_head(nodes[0])
+                else:
+                    val = ''.join([self.visit(z) for z in nodes])
+                n = sync.first_leading_line
+                n = None if n == first else n - start
+                data = val, n
+            if n is not None:
+                sync.first_leading_line = start + n
+            used[key] = data
+            result.append(val)
         self.level = 0
-        self.sync = sync = TokenSync(s, tokens)
+        self.class_stack = []
+        cache.clear()
+        cache.update(used)
+        if self.controller:
+            metrics = self.controller.metrics
+            metrics.inc('cache_hits', hits, cache='statement')
+            metrics.inc('cache_misses', len(units) - hits, cache='statement')
+        return ''.join(result)
+
+    def make_units(self, node):
+        '''
+        Return a list of (start, level, class_name, nodes) tuples for the
+        units of the Module node. start is the unit's zero-based first line.
+
+        Statements sharing a line form a single unit. A level 0 unit with a
+        class name is the head of a class whose members are separate units.
+        '''
+        sync = self.sync
+
+        def first_line(z):
+            linenos = [z.lineno] + [y.lineno for y in getattr(z, 'decorator_list', [])]
+            return sync.first_line(min(linenos))
+
+        units = []
+        for z in node.body:
+            start = first_line(z) if units else 0
+            members = []
+            if isinstance(z, ast.ClassDef):
+                members = [(first_line(z2), z2) for z2 in z.body]
+            starts = [start] + [n for n, z2 in members]
+            if units and start <= units[-1][0]:
+                units[-1][3].append(z)
+            elif members and all([a < b for a, b in zip(starts, starts[1:])]):
+                units.append((start, 0, z.name, [z]))
+                for n, z2 in members:
+                    units.append((n, 1, z.name, [z2]))
+            else:
+                units.append((start, 0, None, [z]))
+        return units
+
+    def unit_key(self, lines, start, level, class_name):
+        '''
+        Return the cache key for a unit starting at the given line.
+
+        A unit's output depends on its own lines, on the ignored lines that
+        precede it but have not yet been consumed, and on its context.
+        '''
+        sync = self.sync
+        leading = []
+        for token in sync.ignored_lines[sync.first_leading_line:start]:
+            leading.append(sync.token_raw_val(token) if token else '\0')
+        context = repr((level, class_name, self.strip_comments))
+        aList = [context, '\0'.join(leading)] + lines
+        s = '\1'.join(aList)
+        if isPython3:
+            s = s.encode('utf-8')
+        return hashlib.sha1(s).hexdigest()
+
+    def init_sync(self, s, tokens):
+        '''Create the TokenSync object for s and return it.'''
+        self.level = 0
+        warning = self.controller.sync_warning if self.controller else None
+        self.sync = sync = TokenSync(s, tokens,
+            comments=not self.strip_comments, warning=warning)
         # Create aliases here for convenience.
         self.sync_string = sync.sync_string
         self.last_node = sync.last_node
@@ -167,13 +498,7 @@ class CoffeeScriptTraverser(object):
         self.tokens_for_statment = sync.tokens_for_statement
         self.trailing_comment = sync.trailing_comment
         self.trailing_comment_at_lineno = sync.trailing_comment_at_lineno
-        # Compute the result.
-        val = self.visit(node)
-        sync.check_strings()
-        # if isinstance(val, list): # testing:
-            # val = ' '.join(val)
-        val += ''.join(sync.trailing_lines())
-        return val or ''
+        return sync
 
     def indent(self, s):
         '''Return s, properly indented.'''
@@ -217,6 +542,17 @@ class CoffeeScriptTraverser(object):
 
     def do_ClassDef(self, node):
 
+        result = [self.class_head(node)]
+        self.class_stack.append(node.name)
+        for i, z in enumerate(node.body):
+            self.level += 1
+            result.append(self.visit(z))
+            self.level -= 1
+        self.class_stack.pop()
+        return ''.join(result)
+
+    def class_head(self, node):
+        '''Return the leading lines and the class line of a ClassDef node.'''
         result = self.leading_lines(node)
         tail = self.trailing_comment(node)
         name = node.name # Only a plain string is valid.
@@ -233,12 +569,6 @@ class CoffeeScriptTraverser(object):
         else:
             s = 'class %s' % name
         result.append(self.indent(s + tail))
-        self.class_stack.append(name)
-        for i, z in enumerate(node.body):
-            self.level += 1
-            result.append(self.visit(z))
-            self.level -= 1
-        self.class_stack.pop()
         return ''.join(result)
 
     # 2: FunctionDef(identifier name, arguments args, stmt* body, expr* decorator_list)
@@ -407,6 +737,18 @@ class CoffeeScriptTraverser(object):
             result.append(' if %s' % (''.join(ifs)))
         return ''.join(result)
 
+    def do_Constant(self, node): # Python 3.8 and above.
+        '''All literals in Python 3.8 and above.'''
+        value = node.value
+        if isinstance(value, (str, bytes)):
+            return self.do_Str(node)
+        elif value is Ellipsis:
+            return self.do_Ellipsis(node)
+        elif value is None or isinstance(value, bool):
+            return self.do_NameConstant(node)
+        else:
+            return repr(value)
+
     def do_Dict(self, node):
         assert len(node.keys) == len(node.values)
         items, result = [], []
@@ -550,9 +892,11 @@ class CoffeeScriptTraverser(object):
         Return the tail of the 'else' or 'finally' statement following the given body.
         aList is the node.orelse or node.finalbody list.
         '''
+        if self.strip_comments:
+            return '\n'
         node = self.last_node(body)
         if node:
-            max_n = node.lineno
+            max_n = self.sync.node_lineno(node)
             leading = self.leading_lines(aList[0])
             if leading:
                 result.extend(leading)
@@ -600,7 +944,7 @@ class CoffeeScriptTraverser(object):
 
     def do_Continue(self, node):
         
-        head = self.leading_lines(node)
+        head = self.leading_string(node)
         tail = self.trailing_comment(node)
         return head + self.indent('continue') + tail
 
@@ -679,7 +1023,7 @@ class CoffeeScriptTraverser(object):
 
     def do_Global(self, node):
         
-        head = self.leading_lines(node)
+        head = self.leading_string(node)
         tail = self.trailing_comment(node)
         s = 'global %s' % ','.join(node.names)
         return head + self.indent(s) + tail
@@ -949,6 +1293,163 @@ class CoffeeScriptTraverser(object):
         return head + self.indent(s) + tail
 
 
+class ConversionFailure(Exception):
+    '''An exception describing a file that could not be converted.'''
+
+    def __init__(self, message, line=None, col=None):
+        Exception.__init__(self, message)
+        self.line = line
+        self.col = col
+
+
+class Explainer(object):
+    '''
+    A class that shows where the time converting one file is spent.
+
+    Each top-level statement and each class and def at any level is a
+    region. The Explainer times the regions and counts the TokenSync calls
+    made while each region is innermost.
+    '''
+
+    def __init__(self, controller):
+        '''Ctor for Explainer class.'''
+        self.controller = controller
+        self.sync_names = ('leading_lines', 'last_node', 'sync_string',
+            'trailing_comment_at_lineno')
+        self.phases = [] # List of (name, seconds).
+        self.regions = [] # List of dicts, in the order visited.
+        self.stack = [] # The open regions.
+
+    def explain(self, fn, s):
+        '''Convert s, the contents of file fn. Return the report.'''
+        t1 = clock()
+        tokens = self.controller.tokenize_source(s)
+        t2 = clock()
+        node = ast.parse(s, filename=fn, mode='exec')
+        t3 = clock()
+        traverser = CoffeeScriptTraverser(controller=self.controller,
+            strip_comments=self.controller.strip_comments)
+        self.instrument(traverser)
+        t4 = clock()
+        traverser.format(node, s, tokens)
+        t5 = clock()
+        self.phases = [('tokenize', t2 - t1), ('parse', t3 - t2),
+            ('sync', self.init_time), ('traverse', t5 - t4 - self.init_time)]
+        return self.report(fn, s, t5 - t1)
+
+    def instrument(self, traverser):
+        '''Wrap traverser.visit and the methods of the traverser's TokenSync.'''
+        visit, init_sync = traverser.visit, traverser.init_sync
+        stack = self.stack
+        self.init_time = 0.0
+
+        def region_visit(node):
+            if not (isinstance(node, ast.stmt) and (
+                not stack or node.__class__.__name__ in
+                ('ClassDef', 'FunctionDef', 'AsyncFunctionDef')
+            )):
+                return visit(node)
+            d = self.new_region(node)
+            stack.append(d)
+            t1 = clock()
+            try:
+                return visit(node)
+            finally:
+                d['time'] += clock() - t1
+                stack.pop()
+                if stack:
+                    stack[-1]['child_time'] += d['time']
+
+        def counting_init_sync(s, tokens):
+            t1 = clock()
+            sync = init_sync(s, tokens)
+            self.init_time += clock() - t1
+            # Wrap the methods of sync itself, so that the calls made by
+            # sync.leading_string and sync.trailing_comment are counted.
+            for name in self.sync_names:
+                f = self.counter(name, getattr(sync, name))
+                setattr(sync, name, f)
+                setattr(traverser, name, f)
+            return sync
+
+        traverser.visit = region_visit
+        traverser.init_sync = counting_init_sync
+
+    def counter(self, name, f):
+        '''Return a wrapper for f that counts calls in the innermost region.'''
+        stack = self.stack
+
+        def wrapper(*args, **keys):
+            if stack:
+                counts = stack[-1]['calls']
+                counts[name] = counts.get(name, 0) + 1
+            return f(*args, **keys)
+
+        return wrapper
+
+    def new_region(self, node):
+        '''Create and return the region for the statement node.'''
+        end = getattr(node, 'end_lineno', None) or max(
+            [getattr(z, 'lineno', 0) for z in ast.walk(node)])
+        kind = node.__class__.__name__
+        if kind in ('ClassDef', 'FunctionDef', 'AsyncFunctionDef'):
+            names = [z['node'].name for z in self.stack if hasattr(z['node'], 'name')]
+            prefix = 'class' if kind == 'ClassDef' else 'def'
+            name = '%s %s' % (prefix, '.'.join(names + [node.name]))
+        else:
+            name = kind
+        d = {'node': node, 'name': name, 'start': node.lineno, 'end': end,
+            'time': 0.0, 'child_time': 0.0, 'calls': {}}
+        self.regions.append(d)
+        return d
+
+    def report(self, fn, s, total):
+        '''Return the sorted report and the annotated listing.'''
+        lines = g.splitLines(s)
+        result = ['explain: %s: %s lines, %.3f sec' % (fn, len(lines), total)]
+        result.append(', '.join(['%s %.3f' % z for z in self.phases]))
+        result.append('')
+        result.append('%8s %8s %6s %6s %6s %6s %6s  %-11s %s' % (
+            'self ms', 'incl ms', 'self%', 'lead', 'last', 'string', 'trail',
+            'lines', 'region'))
+        for d in self.regions:
+            d['self'] = max(0.0, d['time'] - d['child_time'])
+        for d in sorted(self.regions, key=lambda d: -d['self']):
+            calls = d['calls']
+            result.append('%8.2f %8.2f %5.1f%% %6s %6s %6s %6s  %-11s %s' % (
+                d['self'] * 1000, d['time'] * 1000, 100.0 * d['self'] / (total or 1),
+                calls.get('leading_lines', 0), calls.get('last_node', 0),
+                calls.get('sync_string', 0), calls.get('trailing_comment_at_lineno', 0),
+                '%s-%s' % (d['start'], d['end']), d['name']))
+        result.append('')
+        result.extend(self.listing(lines))
+        return '\n'.join(result) + '\n'
+
+    def listing(self, lines):
+        '''
+        Return the lines of the source, annotated with the self time of the
+        innermost region containing each line. The heat column shows the
+        self time per line of that region.
+        '''
+        innermost = [None] * (len(lines) + 1)
+        for d in sorted(self.regions, key=lambda d: d['end'] - d['start'], reverse=True):
+            for i in range(d['start'], min(d['end'], len(lines)) + 1):
+                innermost[i] = d
+        density = lambda d: d['self'] / (d['end'] - d['start'] + 1)
+        top = max([density(d) for d in self.regions] or [0]) or 1
+        heat = ' .:-=+*#%@'
+        result = []
+        for i, line in enumerate(lines):
+            d = innermost[i + 1]
+            if d:
+                level = int(round(density(d) / top * (len(heat) - 1)))
+                ms = '%8.2f' % (d['self'] * 1000) if d['start'] == i + 1 else ''
+            else:
+                level, ms = 0, ''
+            result.append('%8s %s %5s| %s' % (ms, heat[level], i + 1, line.rstrip('\n')))
+        return result
+
+
 class LeoGlobals(object):
     '''A class supporting g.pdb and g.trace for compatibility with Leo.'''
 
@@ -1157,12 +1658,84 @@ class MakeCoffeeScriptController(object):
         # Ivars set on the command line...
         self.config_fn = None
         self.enable_unit_tests = False
+        self.bundle_by = None # None, 'package' or 'directory'.
+        self.check = False # True: compare outputs instead of writing them.
+        self.show_diffs = False
         self.files = [] # May also be set in the config file.
+        self.exit_status = 0
+        self.incremental = False
+        self.journal_fn = None
+        self.resume = False
+        self.git_rev = None # A git revision.
+        self.since = None # A git revision.
+        self.io_threads = 0 # The number of reader and writer threads.
+        self.jobs = 1 # The number of worker processes.
+        self.threads = 1 # The number of conversion threads.
+        self.only = [] # Qualified names of the classes and functions to convert.
+        self.strip_comments = False
         self.section_names = ('Global',)
+        self.config_jobs = [] # List of (name, ivars) tuples, one per [Job NAME] section.
+        self.job_name = None # The name of the job being run.
         # Ivars set in the config file...
         self.output_directory = self.finalize('.')
         self.overwrite = False
         self.verbose = False # Trace config arguments.
+        # Ivars for incremental conversion...
+        self.statement_cache = {} # Keys are full file names.
+        self.statement_cache_version = 1, script_sha1()
+        self.check_cache = None # Keys are output file names.
+        self.check_cache_version = 1, script_sha1()
+        self.bundle_cache_version = 1, script_sha1()
+        self.blob_cache_size = 100 # In MB.
+        self.blob_cache_version = 2
+        # Ivars for parallel conversion...
+        self.min_chunk_lines = 500
+        self.pool = None
+        self.print_lock = threading.Lock()
+        # Ivars for the journal and the final report...
+        self.failures = [] # List of dicts.
+        self.journal = None # An open file.
+        self.journal_done = {} # The entries of the journal read by --resume.
+        self.journal_lock = threading.Lock()
+        self.n_converted = 0
+        self.n_resumed = 0
+        self.stale = [] # Output files that differ from their sources.
+        # Ivars for archive output...
+        self.output_archive = None # A .zip, .tar or .tar.gz file name.
+        self.archive = None # An open zipfile.ZipFile or tarfile.TarFile.
+        self.archive_index = {} # Keys are entry names, values are dicts.
+        self.archive_inputs = {} # Keys are output file names, values are input file names.
+        self.archive_lock = threading.Lock()
+        self.archive_names = set() # Names of the entries written by this run.
+        self.archive_tmp_fn = None
+        self.old_archive_index = {} # The index of the previous archive.
+        self.old_archive_names = set() # Names of all entries of the previous archive.
+        # Ivars for logging and metrics...
+        self.log_file = sys.stderr
+        self.log_level = 0 # A value of log_levels, or 0 for no logging.
+        self.sync_warnings = None # Collects the sync warnings of a worker process.
+        self.metrics = Metrics(enabled=False) # Enabled by --metrics.
+        self.metrics_fn = None
+        # Ivars for profiling...
+        self.explain_fn = None
+        self.profile_fn = None # The .pstats file.
+        self.profiler = None # A cProfile.Profile.
+        # Ivars for the front-end cache...
+        self.front_end_cache = None # A directory.
+        self.front_end_cache_size = 100 # In MB.
+        self.front_end_cache_version = 1
+        # Ivars for per-file budgets...
+        self.file_max_rss = None # In MB.
+        self.file_timeout = None # In seconds.
+        self.max_source_size = None # In bytes.
+        self.workers = [] # Idle (multiprocessing.Process, connection) tuples.
+        self.worker_lock = threading.Lock()
+        # Ivars for sharding...
+        self.input_directory = None
+        self.manifest = None # A dict describing the converted files.
+        self.manifest_fn = None
+        self.merge_manifests = False
+        self.shard = None # An (index, count) tuple.
 
     def finalize(self, fn):
         '''Finalize and regularize a filename.'''
@@ -1176,38 +1749,1019 @@ class MakeCoffeeScriptController(object):
         Make a stub file in the output directory for all source files mentioned
         in the [Source Files] section of the configuration file.
         '''
-        if not fn.endswith('.py'):
-            print('not a python file', fn)
+        out_fn = self.output_file_name(fn)
+        if not out_fn:
             return
-        if not os.path.exists(fn):
-            print('not found', fn)
+        try:
+            if s is None:
+                s = open(fn).read()
+        except IOError as e:
+            self.fail_file(fn, 'can not read: %s' % e)
             return
-        base_fn = os.path.basename(fn)
-        out_fn = os.path.join(self.output_directory, base_fn)
-        out_fn = os.path.normpath(out_fn)
-        out_fn = out_fn[: -3] + '.coffee'
+        s = self.convert_file(fn, out_fn, s)
+        if s is not None:
+            self.write_result(fn, out_fn, s)
+
+    def write_result(self, fn, out_fn, s):
+        '''Write the coffeescript s converted from fn to out_fn.'''
+        try:
+            self.write_coffeescript_file(out_fn, s)
+        except IOError as e:
+            self.fail_file(fn, 'can not write: %s' % e)
+        else:
+            self.finish_file(fn)
+
+    def convert_file(self, fn, out_fn, s):
+        '''
+        Convert the python source s of file fn, to be written to out_fn.
+        Return the coffeescript, or None if the conversion failed.
+        Record the conversion in the manifest.
+        '''
+        if self.log_level >= log_levels['debug']:
+            self.log('debug', 'converting', input=fn, output=out_fn)
+        t1 = clock()
+        result = None
+        if self.check_cache is not None:
+            result = self.checked_output(out_fn, s)
+        try:
+            if result is not None:
+                self.metrics.inc('cache_hits', cache='check')
+            elif self.max_source_size and self.source_size(fn, s) > self.max_source_size:
+                raise ConversionFailure('source too large: %s bytes' % self.source_size(fn, s))
+            elif self.file_timeout or self.file_max_rss:
+                result = self.convert_with_budget(fn, s)
+            elif self.profiler:
+                result = self.profiler.runcall(self.convert, fn, s)
+            else:
+                result = self.convert(fn, s)
+        except ConversionFailure as e:
+            self.fail_file(fn, str(e), e.line, e.col)
+            return None
+        except Exception as e:
+            line, col = self.error_location(e, sys.exc_info()[2])
+            self.fail_file(fn, '%s: %s' % (e.__class__.__name__, e), line, col)
+            return None
+        t2 = clock()
+        if self.check_cache is not None:
+            self.check_cache[out_fn] = (
+                string_sha1(s), self.options_key(), string_sha1(result))
+        self.metrics.inc('bytes', len(s), direction='read')
+        self.metrics.inc('bytes', len(result), direction='written')
+        self.metrics.observe('conversion_seconds', t2 - t1)
+        if self.log_level >= log_levels['info']:
+            self.log('info', 'converted', input=fn, output=out_fn,
+                bytes=len(s), seconds=round(t2 - t1, 6))
+        if self.manifest is not None:
+            self.manifest['files'].append({
+                'input': self.relative_input(fn),
+                'input_sha1': string_sha1(s),
+                'output': self.relative_output(fn),
+                'output_sha1': string_sha1(result),
+                'bytes': len(s),
+                'seconds': round(t2 - t1, 6),
+            })
+        return result
+
+    def source_size(self, fn, s):
+        '''
+        Return the size in bytes of the python source s of file fn: the size
+        of the file, or of s encoded as utf-8 for archive members and blobs.
+        '''
+        if os.path.isfile(fn):
+            return os.path.getsize(fn)
+        return len(s.encode('utf-8')) if isPython3 else len(s)
+
+    def convert_with_budget(self, fn, s):
+        '''
+        Convert s in an idle worker process, starting one if there is none,
+        and killing the worker if it exceeds the time or memory budget.
+        Return the coffeescript or raise ConversionFailure.
+        '''
+        with self.worker_lock:
+            worker = self.workers.pop() if self.workers else None
+        if not worker:
+            worker = self.start_worker()
+        try:
+            ok, data = self.convert_in_budget_worker(worker, fn, s)
+        except BaseException:
+            self.stop_worker(worker, kill=True)
+            raise
+        with self.worker_lock:
+            self.workers.append(worker)
+        if ok:
+            return data
+        raise ConversionFailure(*data)
+
+    def convert_in_budget_worker(self, worker, fn, s):
+        '''
+        Convert s in worker, a (process, connection) tuple. Report the
+        worker's sync warnings and return its (ok, data) reply, or raise
+        ConversionFailure if the worker dies or exceeds a budget.
+        '''
+        process, conn = worker
+        # Workers outlive jobs, so send the options of the current job.
+        conn.send((fn, s, {'only': self.only, 'strip_comments': self.strip_comments}))
+        t1 = time.time()
+        while not conn.poll(0.05):
+            elapsed = time.time() - t1
+            if not process.is_alive():
+                raise ConversionFailure('worker died: exit code %s' % process.exitcode)
+            elif self.file_timeout and elapsed > self.file_timeout:
+                raise ConversionFailure('time budget exceeded: %s seconds' % self.file_timeout)
+            elif self.file_max_rss and self.worker_rss(process) > self.file_max_rss:
+                raise ConversionFailure('memory budget exceeded: %s MB' % self.file_max_rss)
+        ok, data, warnings = conn.recv()
+        for event, line, s2 in warnings:
+            self.sync_warning(event, line, s2)
+        return ok, data
+
+    def start_worker(self):
+        '''Start a worker process for convert_with_budget and return it.'''
+        options = {
+            'front_end_cache': self.front_end_cache,
+            'profile_fn': self.profile_fn,
+        }
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=convert_in_worker, args=(child_conn, options))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def stop_worker(self, worker, kill=False):
+        '''Stop a worker process, killing it if kill is True.'''
+        process, conn = worker
+        if kill:
+            process.terminate()
+        else:
+            conn.send(None)
+        process.join()
+        conn.close()
+
+    def stop_workers(self):
+        '''Stop all idle worker processes.'''
+        with self.worker_lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.stop_worker(worker)
+
+    def worker_rss(self, process):
+        '''Return the resident set size of a worker process in MB, or 0 if unknown.'''
+        try:
+            f = open('/proc/%s/statm' % process.pid)
+            pages = int(f.read().split()[1])
+            f.close()
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+        return pages * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+
+    def error_location(self, e, tb):
+        '''
+        Return the (line, column) in the source at which exception e, with
+        traceback tb, was raised. Either may be None.
+        '''
+        if isinstance(e, SyntaxError):
+            return e.lineno, e.offset
+        if isinstance(e, tokenize.TokenError) and len(e.args) > 1:
+            return e.args[1]
+        # Use the innermost node being visited by the traverser.
+        line = None
+        while tb:
+            node = tb.tb_frame.f_locals.get('node')
+            if isinstance(node, ast.AST) and getattr(node, 'lineno', None):
+                line = node.lineno
+            tb = tb.tb_next
+        return line, None
+
+    def fail_file(self, fn, error, line=None, col=None):
+        '''Report and record a file whose conversion failed.'''
+        location = ':'.join([str(z) for z in (fn, line, col) if z is not None])
+        self.message('failed: %s: %s' % (location, error))
+        if self.log_level >= log_levels['error']:
+            self.log('error', 'failed', input=fn, error=error, line=line, column=col)
+        self.finish_file(fn, {'error': error, 'line': line, 'column': col})
+
+    def finish_file(self, fn, failure=None):
+        '''
+        Record a completed file, successful unless failure is a dict
+        describing the error, in the journal and in the final report.
+        '''
+        d = {'input': fn, 'status': 'failed' if failure else 'ok'}
+        d.update(failure or {})
+        source = self.source_file(fn)
+        if os.path.exists(source):
+            d['size'], d['mtime'] = os.path.getsize(source), os.path.getmtime(source)
+        self.metrics.inc('files', status=d['status'])
+        with self.journal_lock:
+            if failure:
+                self.failures.append(d)
+            else:
+                self.n_converted += 1
+            if self.journal:
+                self.journal.write(json.dumps(d, sort_keys=True) + '\n')
+                self.journal.flush()
+
+    def source_file(self, fn):
+        '''
+        Return the file that contains fn: fn itself, or the archive or Leo
+        outline of a member named 'ARCHIVE:PATH'.
+        '''
+        if not os.path.exists(fn):
+            i = fn.find(':')
+            while i > -1:
+                source = fn[: i]
+                if (self.is_archive_input(source) or source.endswith('.leo')) and (
+                    os.path.isfile(source)
+                ):
+                    return source
+                i = fn.find(':', i + 1)
+        return fn
+
+    def journal_entry(self, fn):
+        '''
+        Return the journal entry of the previous run for fn, or None if there
+        is none or the file containing fn has changed since.
+        '''
+        d = self.journal_done.get(fn)
+        source = self.source_file(fn)
+        if (d and os.path.exists(source) and
+            d.get('size') == os.path.getsize(source) and
+            d.get('mtime') == os.path.getmtime(source)
+        ):
+            return d
+        return None
+
+    def resume_file(self, fn):
+        '''
+        Return True if the previous run completed fn and the file containing
+        it has not changed since, counting fn as resumed.
+        '''
+        d = self.journal_entry(fn)
+        if not d:
+            return False
+        self.metrics.inc('cache_hits', cache='journal')
+        with self.journal_lock:
+            self.n_resumed += 1
+            if d['status'] == 'failed':
+                self.failures.append(d)
+        return True
+
+    def output_file_name(self, fn):
+        '''
+        Return the full path to the .coffee file for fn, or None if fn should
+        not be converted.
+        '''
+        if not fn.endswith('.py'):
+            self.skip_file('not a python file', 'not a python file %s' % fn, input=fn)
+            return None
+        if not os.path.exists(fn):
+            self.skip_file('not found', 'not found %s' % fn, input=fn)
+            return None
+        out_fn = self.coffee_file_name(fn)
+        if self.incremental and self.archive and self.unchanged_entry(fn, out_fn):
+            self.metrics.inc('cache_hits', cache='archive')
+            self.skip_file('unchanged', 'unchanged: %s' % self.archive_name(out_fn), input=fn)
+            return None
+        if not self.check_output_file(out_fn):
+            return None
+        if self.archive:
+            with self.archive_lock:
+                self.archive_inputs[out_fn] = fn
+        return out_fn
+
+    def check_output_file(self, out_fn):
+        '''Return True if out_fn may be written.'''
+        if self.archive:
+            return self.check_archive_entry(out_fn)
         dir_ = os.path.dirname(out_fn)
+        if self.check:
+            return True # out_fn is only compared.
         if os.path.exists(out_fn) and not self.overwrite:
-            print('file exists: %s' % out_fn)
+            self.skip_file('file exists', 'file exists: %s' % out_fn, output=out_fn)
         elif not dir_ or os.path.exists(dir_):
-            t1 = time.clock()
-            if s is None:
+            return True
+        else:
+            self.skip_file('no output directory',
+                'output directory not not found: %s' % dir_, output=out_fn)
+        return False
+
+    def coffee_file_name(self, fn):
+        '''Return the full path to the .coffee file for python file fn.'''
+        base_fn = os.path.basename(fn)
+        out_fn = os.path.join(self.output_directory, base_fn)
+        out_fn = os.path.normpath(out_fn)
+        return out_fn[: -3] + '.coffee'
+
+    def message(self, s):
+        '''Print s. This may be called from any thread.'''
+        with self.print_lock:
+            print(s)
+
+    def log(self, level, event, **fields):
+        '''
+        Write a structured event to the log, if level is enabled.
+        Callers test self.log_level first, so disabled events cost nothing.
+        '''
+        if log_levels[level] <= self.log_level:
+            d = {'time': round(time.time(), 6), 'level': level, 'event': event}
+            d.update(fields)
+            line = json.dumps(d, sort_keys=True) + '\n'
+            with self.print_lock:
+                self.log_file.write(line)
+                self.log_file.flush()
+
+    def skip_file(self, reason, s, **fields):
+        '''Report a file that is not converted. s is the message to print.'''
+        self.message(s)
+        self.metrics.inc('files_skipped', reason=reason)
+        if self.log_level >= log_levels['info']:
+            self.log('info', 'skipped', reason=reason, **fields)
+
+    def sync_warning(self, event, line, s):
+        '''
+        Count and report a warning from a TokenSync. In worker processes,
+        just collect the warning for the parent process.
+        '''
+        if self.sync_warnings is not None:
+            self.sync_warnings.append((event, line, s))
+            return
+        self.metrics.inc('sync_warnings', kind=event)
+        if self.log_level >= log_levels['warning']:
+            self.log('warning', event, line=line, string=s)
+        elif not self.log_level:
+            g.trace('===== %s line:' % event, line, s)
+
+    def write_metrics(self):
+        '''
+        Write self.metrics to self.metrics_fn, replacing a Prometheus textfile
+        (.prom) atomically or appending a JSON line for this run.
+        '''
+        fn = self.metrics_fn
+        if fn.endswith('.prom'):
+            f, tmp_fn = self.open_temp_file(fn)
+            f.write(self.metrics.to_prometheus())
+            f.close()
+            replace_file(tmp_fn, fn)
+        else:
+            f = open(fn, 'a')
+            f.write(json.dumps(self.metrics.to_json(), sort_keys=True) + '\n')
+            f.close()
+
+    def write_coffeescript_file(self, out_fn, s):
+        '''Write the coffeescript s to out_fn.'''
+        if self.check:
+            self.compare_coffeescript_file(out_fn, s)
+            return
+        if self.archive:
+            self.write_archive_entry(out_fn, s)
+            return
+        f, tmp_fn = self.open_temp_file(out_fn)
+        self.output_time_stamp(f)
+        f.write(s)
+        f.close()
+        replace_file(tmp_fn, out_fn)
+        self.message('wrote: %s' % out_fn)
+
+    def compare_coffeescript_file(self, out_fn, s):
+        '''
+        Compare the coffeescript s with the contents of out_fn, ignoring the
+        time-stamp line. Report out_fn if it is missing or stale.
+        '''
+        if not os.path.exists(out_fn):
+            self.stale_file(out_fn, 'missing', '', s)
+            return
+        f = open(out_fn)
+        old = f.read()
+        f.close()
+        if old.startswith('# python_to_coffeescript:'):
+            old = old[old.find('\n') + 1:]
+        if old != s:
+            self.stale_file(out_fn, 'stale', old, s)
+
+    def stale_file(self, out_fn, reason, old=None, new=None):
+        '''
+        Report and record an output file that does not match its source.
+        Show the differences of old and new if --diff is in effect.
+        '''
+        lines = ['%s: %s\n' % (reason, out_fn)]
+        if self.show_diffs and new is not None:
+            lines.extend(difflib.unified_diff(old.splitlines(True),
+                new.splitlines(True), out_fn, out_fn + ' (converted)'))
+        self.message(''.join(lines).rstrip('\n'))
+        self.metrics.inc('files_stale', reason=reason)
+        with self.journal_lock:
+            self.stale.append(out_fn)
+
+    def open_temp_file(self, fn, mode='w'):
+        '''
+        Open a temporary file in fn's directory. Return (f, temp_fn).
+        Renaming temp_fn to fn replaces fn atomically, so concurrent runs
+        never see partially written files.
+        '''
+        tmp_fn = '%s.tmp-%s-%s' % (fn, os.getpid(), threading.current_thread().ident)
+        return open(tmp_fn, mode), tmp_fn
+
+    def archive_name(self, out_fn):
+        '''Return the name of the archive entry for out_fn.'''
+        return os.path.relpath(out_fn, self.output_directory).replace(os.sep, '/')
+
+    def begin_archive(self):
+        '''
+        Open a temporary archive that will replace self.output_archive.
+        Read the index of the previous archive, if any.
+        Return False if the archive can not be opened.
+        '''
+        fn = self.output_archive
+        if os.path.exists(fn):
+            try:
+                old = self.open_archive(fn, 'r')
+                self.old_archive_names = set(self.archive_members(old))
+                data = self.read_archive_member(old, '.py2cs-index')
+                if data is not None:
+                    self.old_archive_index = json.loads(data.decode('utf-8'))
+                old.close()
+            except (IOError, OSError, ValueError,
+                zipfile.BadZipfile, tarfile.TarError
+            ) as e:
+                print('--output-archive: can not read %s: %s' % (fn, e))
+                return False
+        try:
+            self.archive_tmp_fn = '%s.tmp-%s' % (fn, os.getpid())
+            self.archive = self.open_archive(self.archive_tmp_fn, 'w')
+        except (IOError, OSError) as e:
+            print('--output-archive: can not write %s: %s' % (fn, e))
+            return False
+        return True
+
+    def end_archive(self):
+        '''
+        Copy the entries of the previous archive that were not rewritten,
+        write the index and replace self.output_archive.
+        '''
+        fn = self.output_archive
+        index = self.archive_index
+        if self.old_archive_names - self.archive_names:
+            old = self.open_archive(fn, 'r')
+            for name in self.archive_members(old):
+                if name not in self.archive_names and name != '.py2cs-index':
+                    data = self.read_archive_member(old, name)
+                    self.add_archive_member(name, data)
+                    if name in self.old_archive_index:
+                        index[name] = self.old_archive_index[name]
+            old.close()
+        data = json.dumps(index, indent=1, sort_keys=True)
+        self.add_archive_member('.py2cs-index', data.encode('utf-8'))
+        self.archive.close()
+        self.archive = None
+        replace_file(self.archive_tmp_fn, fn)
+        print('wrote: %s' % fn)
+
+    def check_archive_entry(self, out_fn):
+        '''Return True if the archive entry for out_fn may be written.'''
+        name = self.archive_name(out_fn)
+        with self.archive_lock:
+            if name in self.archive_names or (
+                name in self.old_archive_names and not self.overwrite
+            ):
+                self.skip_file('file exists', 'file exists: %s' % name, output=name)
+                return False
+            # Reserve the name, so no other file can claim it.
+            self.archive_names.add(name)
+            return True
+
+    def unchanged_entry(self, fn, out_fn):
+        '''
+        Return True if the previous archive contains the entry for fn,
+        converted from the same file with the same options.
+        '''
+        d = self.old_archive_index.get(self.archive_name(out_fn))
+        return bool(d and
+            d.get('input') == fn and
+            d.get('size') == os.path.getsize(fn) and
+            d.get('mtime') == os.path.getmtime(fn) and
+            d.get('options') == self.options_key())
+
+    def write_archive_entry(self, out_fn, s):
+        '''Add the coffeescript s to the archive as the entry for out_fn.'''
+        name = self.archive_name(out_fn)
+        data = self.time_stamp() + s
+        if isPython3:
+            data = data.encode('utf-8')
+        fn = self.archive_inputs.get(out_fn)
+        d = {'options': self.options_key()}
+        if fn and os.path.exists(fn):
+            d.update({'input': fn,
+                'size': os.path.getsize(fn), 'mtime': os.path.getmtime(fn)})
+        self.add_archive_member(name, data)
+        with self.archive_lock:
+            self.archive_index[name] = d
+        self.message('wrote: %s:%s' % (self.output_archive, name))
+
+    def open_archive(self, fn, mode):
+        '''Open the zip or tar archive fn for reading or writing.'''
+        # The format is always that of self.output_archive, not fn.
+        base = self.output_archive
+        if base.endswith('.zip'):
+            return zipfile.ZipFile(fn, mode, zipfile.ZIP_DEFLATED)
+        if mode == 'w' and base.endswith(('.tar.gz', '.tgz')):
+            mode = 'w:gz'
+        return tarfile.open(fn, mode)
+
+    def archive_members(self, archive):
+        '''Return the names of all files in the zip or tar archive.'''
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.namelist()
+        return [z.name for z in archive.getmembers() if z.isfile()]
+
+    def read_archive_member(self, archive, name):
+        '''Return the bytes of the named file in archive, or None.'''
+        try:
+            if isinstance(archive, zipfile.ZipFile):
+                return archive.read(name)
+            f = archive.extractfile(name)
+            data = f.read()
+            f.close()
+            return data
+        except KeyError:
+            return None
+
+    def add_archive_member(self, name, data):
+        '''Add a file containing the bytes data to the open archive.'''
+        with self.archive_lock:
+            if isinstance(self.archive, zipfile.ZipFile):
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                self.archive.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                f = io.BytesIO(data) if isPython3 else io.StringIO(data)
+                self.archive.addfile(info, f)
+
+    def run_pipeline(self):
+        '''
+        Convert all files, reading sources and writing results in
+        self.io_threads background threads, and converting them in
+        self.threads threads. Bounded queues between the stages limit the
+        number of sources and results held in memory.
+        '''
+        n = max(1, self.io_threads)
+        files = iter(self.files)
+        lock = threading.Lock()
+        stop = threading.Event() # Set when the pipeline shuts down.
+        written = set() # Output files claimed by the writers.
+        sources = queue.Queue(maxsize=2 * n) # (fn, out_fn, s) tuples.
+        results = queue.Queue(maxsize=2 * n) # (fn, out_fn, s) tuples.
+
+        def get(q):
+            '''Return the next item of q, or None if the pipeline stops.'''
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def put(q, data):
+            '''Put data into q, unless the pipeline stops.'''
+            while not stop.is_set():
+                try:
+                    q.put(data, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read():
+            while not stop.is_set():
+                with lock:
+                    fn = next(files, None)
+                if fn is None:
+                    break
+                out_fn = self.output_file_name(fn)
+                if out_fn:
+                    try:
+                        f = open(fn)
+                        s = f.read()
+                        f.close()
+                    except IOError as e:
+                        self.fail_file(fn, 'can not read: %s' % e)
+                    else:
+                        put(sources, (fn, out_fn, s))
+
+        def convert():
+            while True:
+                data = get(sources)
+                if data is None:
+                    break
+                fn, out_fn, s = data
+                s = self.convert_file(fn, out_fn, s)
+                if s is not None:
+                    put(results, (fn, out_fn, s))
+
+        def write():
+            while True:
+                data = results.get()
+                if data is None:
+                    break
+                fn, out_fn, s = data
+                # The readers only see the files that existed before this run.
+                with lock:
+                    exists = out_fn in written
+                    written.add(out_fn)
+                if exists and not (self.overwrite or self.check):
+                    self.skip_file('file exists', 'file exists: %s' % out_fn, output=out_fn)
+                else:
+                    self.write_result(fn, out_fn, s)
+
+        def new_thread(f):
+            '''Return a thread running f. An exception in f stops the pipeline.'''
+
+            def run():
+                try:
+                    f()
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            return thread
+
+        errors = [] # Exceptions raised in the threads.
+        readers = [new_thread(read) for i in range(n)]
+        converters = [new_thread(convert) for i in range(self.threads)]
+        writers = [new_thread(write) for i in range(n)]
+        started = [] # The threads to shut down.
+        try:
+            for thread in writers + converters + readers:
+                thread.start()
+                started.append(thread)
+            for thread in readers:
+                thread.join()
+            for thread in converters:
+                put(sources, None)
+            for thread in converters:
+                thread.join()
+        finally:
+            # Stop the readers and converters, then write all results.
+            stop.set()
+            for thread in started:
+                if thread not in writers:
+                    thread.join()
+            # Writers that died take no None, so the queue may stay full.
+            while [z for z in started if z in writers and z.is_alive()]:
+                try:
+                    results.put(None, timeout=0.1)
+                except queue.Full:
+                    pass
+            for thread in started:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def run_bundles(self):
+        '''
+        Convert all files into one .coffee file per package or directory.
+        Regenerate only the bundles whose member files have changed. With
+        --resume, skip the bundles whose members were all completed.
+        '''
+        fn = os.path.join(self.output_directory, '.py2cs-bundles')
+        cache = self.load_pickle(fn, self.bundle_cache_version) or {}
+        bundles = self.bundle_files()
+        top = self.common_directory(list(bundles))
+        for key in sorted(bundles):
+            files = bundles[key]
+            out_fn = self.bundle_file_name(key, top)
+            state = [self.options_key()]
+            for z in files:
+                state.append((z, os.path.getsize(z), os.path.getmtime(z)))
+            if (not self.check and cache.get(out_fn) == state and
+                os.path.exists(out_fn)
+            ):
+                self.skip_file('unchanged', 'unchanged: %s' % out_fn, output=out_fn)
+            elif os.path.exists(out_fn) and all([self.journal_entry(z) for z in files]):
+                # The previous run completed the whole bundle.
+                for z in files:
+                    self.resume_file(z)
+            elif self.check_output_file(out_fn):
+                if self.write_bundle(out_fn, key, files):
+                    cache[out_fn] = state
+        if not self.check:
+            self.save_pickle(fn, cache, self.bundle_cache_version)
+
+    def bundle_files(self):
+        '''
+        Return a dict whose keys are the directories of the bundles and whose
+        values are the sorted lists of their python files.
+        '''
+        bundles = {}
+        for fn in self.files:
+            if not fn.endswith('.py'):
+                self.skip_file('not a python file', 'not a python file %s' % fn, input=fn)
+            elif not os.path.exists(fn):
+                self.skip_file('not found', 'not found %s' % fn, input=fn)
+            else:
+                key = os.path.dirname(fn)
+                if self.bundle_by == 'package':
+                    # Use the top-level package containing fn.
+                    while (os.path.exists(os.path.join(key, '__init__.py')) and
+                        os.path.exists(os.path.join(os.path.dirname(key), '__init__.py'))
+                    ):
+                        key = os.path.dirname(key)
+                bundles.setdefault(key, []).append(fn)
+        for key in bundles:
+            bundles[key].sort()
+        return bundles
+
+    def bundle_file_name(self, key, top):
+        '''
+        Return the full path to the bundle for directory key. The name is the
+        dotted path of key relative to top, the parent of all bundles.
+        '''
+        name = os.path.relpath(key, top).replace(os.sep, '.')
+        return os.path.join(self.output_directory, name + '.coffee')
+
+    def write_bundle(self, out_fn, key, files):
+        '''
+        Convert all files of a bundle, writing their coffeescript to out_fn
+        as each is converted. Each module starts with a boundary marker.
+        Return True if all files were converted.
+        '''
+        parts, ok = [], True
+        if self.check or self.archive:
+            f = None
+        else:
+            f, tmp_fn = self.open_temp_file(out_fn)
+            self.output_time_stamp(f)
+
+        def put(s):
+            if f:
+                f.write(s)
+            else:
+                parts.append(s)
+
+        for fn in files:
+            name = os.path.relpath(fn, os.path.dirname(key)).replace(os.sep, '/')
+            try:
                 s = open(fn).read()
+            except IOError as e:
+                self.fail_file(fn, 'can not read: %s' % e)
+                s = None
+            result = None if s is None else self.convert_file(fn, out_fn, s)
+            if result is None:
+                put('# ===== py2cs module: %s (failed)\n' % name)
+                ok = False
+            else:
+                put('# ===== py2cs module: %s\n' % name)
+                put(result if not result or result.endswith('\n') else result + '\n')
+                self.finish_file(fn)
+        if f:
+            f.close()
+            replace_file(tmp_fn, out_fn)
+            self.message('wrote: %s' % out_fn)
+        else:
+            self.write_coffeescript_file(out_fn, ''.join(parts))
+        return ok
+
+    def convert(self, fn, s):
+        '''Convert the python source s of file fn. Return the coffeescript.'''
+        traverser = CoffeeScriptTraverser(controller=self,
+            strip_comments=self.strip_comments)
+        if self.only:
+            node = ast.parse(s, filename=fn, mode='exec')
+            result, missing = traverser.format_only(node, s, self.only)
+            if missing:
+                raise ConversionFailure('not found: %s' % ', '.join(missing))
+            return result
+        elif self.pool and not self.incremental:
+            return self.format_in_chunks(fn, s)
+        else:
+            tokens = self.tokenize_source(s)
+            node = ast.parse(s, filename=fn, mode='exec')
+            cache = self.statement_cache.setdefault(fn, {}) if self.incremental else None
+            return traverser.format(node, s, tokens, cache)
+
+    def tokenize_source(self, s):
+        '''Return the tokens of s, using the front-end cache if it exists.'''
+        if not self.front_end_cache:
+            readlines = g.ReadLinesClass(s).next
+            return list(tokenize.generate_tokens(readlines))
+        # Tokens may change with the version of python.
+        version = self.front_end_cache_version, sys.version
+        fn = os.path.join(self.front_end_cache, string_sha1(s))
+        table = self.load_pickle(fn, version)
+        if table is None:
+            self.metrics.inc('cache_misses', cache='front_end')
             readlines = g.ReadLinesClass(s).next
             tokens = list(tokenize.generate_tokens(readlines))
-            node = ast.parse(s, filename=fn, mode='exec')
-            s = CoffeeScriptTraverser(controller=self).format(node, s, tokens)
-            f = open(out_fn, 'w')
-            self.output_time_stamp(f)
-            f.write(s)
+            self.save_pickle(fn, self.pack_tokens(s, tokens), version)
+            return tokens
+        self.metrics.inc('cache_hits', cache='front_end')
+        try:
+            os.utime(fn, None) # Mark the entry as recently used.
+        except OSError:
+            pass # Pruned by another run.
+        return self.unpack_tokens(s, table)
+
+    def pack_tokens(self, s, tokens):
+        '''
+        Return a compact table of tokens. The spelling and the line of most
+        tokens are None, because unpack_tokens recovers them from s.
+        '''
+        lines = g.splitLines(s)
+        table = []
+        for t1, t2, t3, t4, t5 in tokens:
+            srow, scol = t3
+            erow, ecol = t4
+            if srow == erow and 0 < srow <= len(lines) and t2 == lines[srow-1][scol:ecol]:
+                t2 = None
+            if t5 == ''.join(lines[srow-1:erow]):
+                t5 = None
+            table.append((t1, t2, srow, scol, erow, ecol, t5))
+        return table
+
+    def unpack_tokens(self, s, table):
+        '''Return the list of tokens packed into table by pack_tokens.'''
+        lines = g.splitLines(s)
+        tokens = []
+        for t1, t2, srow, scol, erow, ecol, t5 in table:
+            if t5 is None:
+                t5 = ''.join(lines[srow-1:erow])
+            if t2 is None:
+                t2 = lines[srow-1][scol:ecol]
+            tokens.append((t1, t2, (srow, scol), (erow, ecol), t5))
+        return tokens
+
+    def prune_front_end_cache(self):
+        '''
+        Remove the least recently used entries of the front-end cache until
+        it holds at most self.front_end_cache_size megabytes.
+        '''
+        self.prune_cache(self.front_end_cache, self.front_end_cache_size)
+
+    def prune_cache(self, dir_, megabytes):
+        '''
+        Remove the least recently used files of the cache directory dir_
+        until it holds at most the given number of megabytes.
+        '''
+        entries = []
+        for name in os.listdir(dir_):
+            fn = os.path.join(dir_, name)
+            if '.tmp-' not in name:
+                try:
+                    stat = os.stat(fn)
+                    entries.append((stat.st_mtime, stat.st_size, fn))
+                except OSError:
+                    pass # Pruned by another run.
+        size = sum([z[1] for z in entries])
+        limit = megabytes * 1024 * 1024
+        for mtime, n, fn in sorted(entries):
+            if size <= limit:
+                break
+            try:
+                os.remove(fn)
+                size -= n
+            except OSError:
+                pass
+
+    def format_in_chunks(self, fn, s):
+        '''
+        Convert s by splitting its top-level statements into chunks of lines
+        and converting the chunks in the worker pool.
+        '''
+        node = ast.parse(s, filename=fn, mode='exec')
+        flags = self.future_flags(node)
+        data = [(fn, z, flags, self.strip_comments, self.front_end_cache, self.profile_fn)
+            for z in self.make_chunks(node, s)]
+        result, pending, offset = [], '', 0
+        results = self.pool.map(format_chunk, data)
+        for z, (head, body, tail, consumed, warnings) in zip(data, results):
+            # The lines of warnings are relative to the chunk.
+            for event, line, s2 in warnings:
+                self.sync_warning(event, line + offset, s2)
+            offset += len(g.splitLines(z[1]))
+            if consumed:
+                # The first consumer gets the ignored lines of previous chunks.
+                result.extend([head, pending, body])
+                pending = tail
+            else:
+                result.append(head)
+                pending += tail
+        result.append(pending)
+        return ''.join(result)
+
+    def future_flags(self, node):
+        '''Return the compiler flags for the __future__ imports of a Module.'''
+        import __future__
+        flags = 0
+        for z in node.body:
+            if isinstance(z, ast.ImportFrom) and z.module == '__future__':
+                for alias in z.names:
+                    feature = getattr(__future__, alias.name, None)
+                    if feature:
+                        flags |= feature.compiler_flag
+        return flags
+
+    def make_chunks(self, node, s):
+        '''
+        Return a list of strings, each containing whole top-level statements.
+        Chunks only start at lines following the end of the previous statement.
+        '''
+        lines = g.splitLines(s)
+        body = node.body
+        if len(body) < 2 or not hasattr(body[0], 'end_lineno'):
+            # end_lineno exists only in Python 3.8 and above.
+            return [s]
+        size = max(self.min_chunk_lines, len(lines) // (2 * self.jobs))
+        chunks, start = [], 0
+        for prev, z in zip(body, body[1:]):
+            linenos = [z.lineno] + [y.lineno for y in getattr(z, 'decorator_list', [])]
+            n = min(linenos) - 1
+            if n >= prev.end_lineno and n - start >= size:
+                chunks.append(''.join(lines[start:n]))
+                start = n
+        chunks.append(''.join(lines[start:]))
+        return chunks
+
+    def statement_cache_path(self):
+        '''Return the path to the statement cache in the output directory.'''
+        return os.path.join(self.output_directory, '.py2cs-statements')
+
+    def load_statement_cache(self):
+        '''Load the statement cache written by a previous incremental run.'''
+        d = self.load_pickle(self.statement_cache_path(), self.statement_cache_version)
+        if d is not None:
+            self.statement_cache = d
+
+    def save_statement_cache(self):
+        '''Write the statement cache to the output directory.'''
+        self.save_pickle(self.statement_cache_path(),
+            self.statement_cache, self.statement_cache_version)
+
+    def check_cache_path(self):
+        '''Return the path to the check cache of the output directory.'''
+        dir_ = os.path.abspath(self.output_directory)
+        return os.path.join(self.front_end_cache, 'checks-%s' % string_sha1(dir_))
+
+    def load_check_cache(self):
+        '''Load the results of the previous --check run from the front-end cache.'''
+        fn = self.check_cache_path()
+        self.check_cache = self.load_pickle(fn, self.check_cache_version) or {}
+
+    def save_check_cache(self):
+        '''Write the results of this --check run to the front-end cache.'''
+        self.save_pickle(self.check_cache_path(), self.check_cache, self.check_cache_version)
+
+    def checked_output(self, out_fn, s):
+        '''
+        Return the contents of out_fn, without the time-stamp, if a previous
+        --check run converted the same source s with the same options to the
+        same contents. Otherwise return None.
+        '''
+        d = self.check_cache.get(out_fn)
+        if d and d[: 2] == (string_sha1(s), self.options_key()) and os.path.exists(out_fn):
+            f = open(out_fn)
+            old = f.read()
             f.close()
-            print('wrote: %s' % out_fn)
-        else:
-            print('output directory not not found: %s' % dir_)
+            if old.startswith('# python_to_coffeescript:'):
+                old = old[old.find('\n') + 1:]
+            if string_sha1(old) == d[2]:
+                return old
+        return None
+
+    def load_pickle(self, fn, version):
+        '''
+        Return the data pickled in file fn by save_pickle, or None if fn does
+        not exist, is bad, or has a different version.
+        '''
+        if not os.path.exists(fn):
+            return None
+        try:
+            f = open(fn, 'rb')
+            version2, data = pickle.load(f)
+            f.close()
+        except Exception:
+            print('ignoring bad cache: %s' % fn)
+            return None
+        return data if version == version2 else None
+
+    def save_pickle(self, fn, data, version):
+        '''Pickle the data and its version to file fn.'''
+        f, tmp_fn = self.open_temp_file(fn, 'wb')
+        pickle.dump((version, data), f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        replace_file(tmp_fn, fn)
 
     def output_time_stamp(self, f):
         '''Put a time-stamp in the output file f.'''
-        f.write('# python_to_coffeescript: %s\n' %
+        f.write(self.time_stamp())
+
+    def time_stamp(self):
+        '''Return the time-stamp line of all output files.'''
+        return '# python_to_coffeescript: %s\n' % (
             time.strftime("%a %d %b %Y at %H:%M:%S"))
 
     def run(self):
@@ -1215,14 +2769,163 @@ class MakeCoffeeScriptController(object):
         Make stub files for all files.
         Do nothing if the output directory does not exist.
         '''
-        if self.enable_unit_tests:
-            self.run_all_unit_tests()
-        if self.files:
+        try:
+            if self.enable_unit_tests:
+                self.run_all_unit_tests()
+            if self.profile_fn:
+                self.begin_profile()
+            if self.front_end_cache and not os.path.exists(self.front_end_cache):
+                os.makedirs(self.front_end_cache)
+            if self.explain_fn:
+                self.explain_file(self.explain_fn)
+                return
+            if self.config_jobs:
+                self.run_jobs()
+            else:
+                self.run_job()
+            if self.log_level >= log_levels['info']:
+                self.log('info', 'finished', converted=self.n_converted,
+                    failed=len(self.failures), resumed=self.n_resumed)
+            if self.front_end_cache:
+                self.prune_front_end_cache()
+            if self.metrics_fn:
+                self.write_metrics()
+            if self.profiler:
+                self.write_profile()
+        finally:
+            if self.log_file is not sys.stderr:
+                self.log_file.close()
+                self.log_file = sys.stderr
+
+    def run_jobs(self):
+        '''
+        Run all jobs of the configuration file in this process. The jobs
+        share the worker pool, the budget workers, the front-end cache, the
+        log and the metrics.
+        Print the time taken by each job.
+        '''
+        failures, rows = [], []
+        n_converted = n_resumed = 0
+        if self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs)
+        try:
+            for name, ivars in self.config_jobs:
+                for key, value in ivars.items():
+                    setattr(self, key, value)
+                # Reset the state of the previous job.
+                self.failures, self.stale = [], []
+                self.n_converted = self.n_resumed = 0
+                self.statement_cache = {}
+                self.check_cache = None
+                self.job_name = name
+                print('job: %s' % name)
+                t1 = clock()
+                self.run_job()
+                t = clock() - t1
+                rows.append((name, self.n_converted, len(self.failures), t))
+                if self.log_level >= log_levels['info']:
+                    self.log('info', 'job', job=name, converted=self.n_converted,
+                        failed=len(self.failures), seconds=round(t, 6))
+                failures.extend(self.failures)
+                n_converted += self.n_converted
+                n_resumed += self.n_resumed
+        finally:
+            self.job_name = None
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+            self.stop_workers()
+        self.failures = failures
+        self.n_converted, self.n_resumed = n_converted, n_resumed
+        print('\n%-24s %9s %6s %8s' % ('job', 'converted', 'failed', 'seconds'))
+        for row in rows:
+            print('%-24s %9s %6s %8.3f' % row)
+        print('%-24s %9s %6s %8.3f' % ('total', n_converted, len(failures),
+            sum([z[3] for z in rows])))
+
+    def run_job(self):
+        '''Convert self.files, or the files of the --git-rev revision.'''
+        if self.since:
+            self.files = self.changed_files(self.files)
+            if self.files is None:
+                self.exit_status = 1
+                return
+            if not self.files:
+                print('no changed files since %s' % self.since)
+                return
+        if self.merge_manifests:
+            self.merge_manifest_files(self.files)
+        elif self.git_rev:
+            if os.path.exists(self.output_directory or ''):
+                if self.output_archive and not self.begin_archive():
+                    self.exit_status = 1
+                    return
+                try:
+                    self.run_git_rev()
+                finally:
+                    self.stop_workers()
+                if self.archive:
+                    self.end_archive()
+                self.report()
+            else:
+                print('output directory not found: %s' % self.output_directory)
+        elif self.files:
             dir_ = self.output_directory
             if dir_:
                 if os.path.exists(dir_):
-                    for fn in self.files:
-                        self.make_coffeescript_file(fn)
+                    if self.output_archive and not self.begin_archive():
+                        self.exit_status = 1
+                        return
+                    if self.shard or self.manifest_fn:
+                        self.begin_manifest()
+                    if not self.check:
+                        self.begin_journal()
+                    if self.incremental:
+                        self.load_statement_cache()
+                    if self.check and self.front_end_cache:
+                        self.load_check_cache()
+                    # run_jobs shares one pool among all jobs.
+                    own_pool = self.jobs > 1 and not self.pool
+                    if own_pool:
+                        self.pool = multiprocessing.Pool(self.jobs)
+                    archives = [z for z in self.files if self.is_archive_input(z)]
+                    leo_files = [z for z in self.files if z.endswith('.leo')]
+                    self.files = [z for z in self.files
+                        if z not in archives and z not in leo_files]
+                    try:
+                        if self.bundle_by:
+                            self.run_bundles()
+                        elif self.io_threads or self.threads > 1:
+                            self.run_pipeline()
+                        else:
+                            for fn in self.files:
+                                self.make_coffeescript_file(fn)
+                        for fn in archives:
+                            self.convert_archive(fn)
+                        for fn in leo_files:
+                            self.convert_leo_file(fn)
+                    finally:
+                        if own_pool:
+                            self.pool.close()
+                            self.pool.join()
+                            self.pool = None
+                        if self.journal:
+                            self.journal.close()
+                            self.journal = None
+                        if not self.job_name:
+                            # run_jobs shares the budget workers among all jobs.
+                            self.stop_workers()
+                    if self.archive:
+                        self.end_archive()
+                    self.report()
+                    # --check writes nothing to the output directory.
+                    if self.incremental and not self.check:
+                        self.save_statement_cache()
+                    if self.check and self.front_end_cache:
+                        self.save_check_cache()
+                    if self.manifest is not None:
+                        self.write_manifest()
                 else:
                     print('output directory not found: %s' % dir_)
             else:
@@ -1230,6 +2933,705 @@ class MakeCoffeeScriptController(object):
         elif not self.enable_unit_tests:
             print('no input files')
 
+    def begin_journal(self):
+        '''
+        Open the journal of completed files. When resuming, remove from
+        self.files all unchanged files completed by the previous run.
+        Archive and Leo members are resumed as they are read.
+        '''
+        fn = self.journal_fn
+        if not fn:
+            name = '.py2cs-journal'
+            if self.shard:
+                name += '-%s-of-%s' % (self.shard[0] + 1, self.shard[1])
+            if self.job_name:
+                # Jobs may share an output directory.
+                name += '-' + re.sub(r'[^\w.-]', '_', self.job_name)
+            fn = os.path.join(self.output_directory, name)
+        done = self.journal_done = {}
+        if self.resume and os.path.exists(fn):
+            f = open(fn)
+            for line in f:
+                try:
+                    d = json.loads(line)
+                    done[d['input']] = d
+                except (ValueError, KeyError):
+                    pass # An interrupted write.
+            f.close()
+        if not self.bundle_by: # run_bundles resumes whole bundles.
+            self.files = [z for z in self.files if not self.resume_file(z)]
+        self.journal = open(fn, 'a' if self.resume else 'w')
+
+    def report(self):
+        '''
+        Summarize the run. Set the exit status if any file failed or,
+        with --check, if any output file is stale.
+        '''
+        if self.check:
+            print('checked: %s, stale: %s' % (self.n_converted, len(self.stale)))
+            if self.stale:
+                self.exit_status = 1
+        if self.failures:
+            self.exit_status = 1
+            print('\nfailures...')
+            for d in self.failures:
+                location = ':'.join([str(z) for z in
+                    (d['input'], d.get('line'), d.get('column')) if z is not None])
+                print('%s: %s' % (location, d.get('error')))
+        if self.failures or self.n_resumed or self.verbose:
+            print('\nconverted: %s, failed: %s, resumed: %s' % (
+                self.n_converted, len(self.failures), self.n_resumed))
+
+    def explain_file(self, fn):
+        '''Print where the time converting fn is spent. Write nothing.'''
+        try:
+            f = open(fn)
+            s = f.read()
+            f.close()
+        except IOError as e:
+            print('--explain: can not read: %s' % e)
+            self.exit_status = 1
+            return
+        sys.stdout.write(Explainer(self).explain(fn, s))
+
+    def begin_profile(self):
+        '''Start profiling. Remove the statistics of previous worker processes.'''
+        self.profiler = cProfile.Profile()
+        for fn in glob.glob('%s.worker-*' % self.profile_fn):
+            os.remove(fn)
+
+    def write_profile(self):
+        '''
+        Merge the statistics of this process and of all worker processes into
+        self.profile_fn, and write their collapsed stacks to a .collapsed file.
+        '''
+        self.profiler.create_stats()
+        sources = [self.profiler] if self.profiler.stats else []
+        workers = glob.glob('%s.worker-*' % self.profile_fn)
+        sources.extend(workers)
+        self.profiler = None
+        if not sources:
+            print('--profile: nothing was profiled')
+            return
+        stats = pstats.Stats(*sources)
+        stats.dump_stats(self.profile_fn)
+        for fn in workers:
+            os.remove(fn)
+        fn = self.profile_fn[: -len('.pstats')] + '.collapsed'
+        f = open(fn, 'w')
+        for line in self.collapsed_stacks(stats):
+            f.write(line + '\n')
+        f.close()
+        print('wrote: %s\nwrote: %s' % (self.profile_fn, fn))
+
+    def collapsed_stacks(self, stats):
+        '''
+        Return the lines of the collapsed stacks, in microseconds, for the
+        pstats.Stats stats. cProfile records only callers, not full stacks,
+        so each function's time is split among its stacks in proportion
+        to the time spent in each call edge.
+        '''
+        callees = {}
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, {})[func] = edge
+        totals = {}
+
+        def label(func):
+            fn, line, name = func
+            if fn == '~':
+                return name
+            return '%s:%s(%s)' % (os.path.basename(fn), line, name)
+
+        def walk(func, path, ct):
+            cc, nc, tt, total_ct, callers = stats.stats[func]
+            ratio = ct / total_ct if total_ct else 0.0
+            path = path + [func]
+            key = ';'.join([label(z) for z in path])
+            totals[key] = totals.get(key, 0.0) + tt * ratio
+            for child, edge in callees.get(func, {}).items():
+                child_ct = edge[3] * ratio
+                if child not in path and child_ct > 1e-6:
+                    walk(child, path, child_ct)
+
+        for func, data in stats.stats.items():
+            if not data[4]:
+                walk(func, [], data[3])
+        return ['%s %s' % (key, int(round(t * 1e6)))
+            for key, t in sorted(totals.items()) if t >= 0.5e-6]
+
+    def begin_manifest(self):
+        '''
+        Create self.manifest. When sharding, reduce self.files to the files
+        of this shard.
+        '''
+        self.input_directory = self.common_directory(self.files)
+        inputs = sorted([self.relative_input(z) for z in self.files])
+        if self.shard:
+            self.files = self.shard_files(self.files)
+        index, count = self.shard or (0, 1)
+        self.manifest = {
+            'version': 1,
+            'shard': [index, count],
+            'all_inputs': len(inputs),
+            'all_inputs_sha1': string_sha1('\n'.join(inputs)),
+            'inputs': dict([(self.relative_input(z), self.relative_output(z))
+                for z in self.files]),
+            'output_directory': self.output_directory,
+            'files': [],
+        }
+
+    def common_directory(self, files):
+        '''Return the deepest directory containing all files.'''
+        dirs = [os.path.dirname(z) for z in files]
+        prefix = os.path.commonprefix(dirs)
+        while prefix and not all([
+            z == prefix or z.startswith(prefix.rstrip(os.sep) + os.sep) for z in dirs
+        ]):
+            prefix = os.path.dirname(prefix)
+        return prefix
+
+    def relative_input(self, fn):
+        '''Return fn relative to the common directory of all inputs.'''
+        return os.path.relpath(fn, self.input_directory).replace(os.sep, '/')
+
+    def relative_output(self, fn):
+        '''
+        Return the path to the .coffee file for fn relative to the output
+        directory, or None if fn is not a python file.
+        '''
+        if not fn.endswith('.py'):
+            return None
+        out_fn = os.path.relpath(self.coffee_file_name(fn), self.output_directory)
+        return out_fn.replace(os.sep, '/')
+
+    def shard_files(self, files):
+        '''
+        Return the files in shard self.shard. Shards are balanced by size.
+
+        The result depends only on the files' sizes and relative paths, so
+        every machine computes the same partition.
+        '''
+        index, count = self.shard
+        aList = sorted([(-os.path.getsize(z), self.relative_input(z), z) for z in files])
+        sizes = [0] * count
+        shards = [[] for i in range(count)]
+        for size, rel_fn, fn in aList:
+            # Assign the file to the smallest shard, preferring lower indices.
+            i = sizes.index(min(sizes))
+            sizes[i] -= size
+            shards[i].append(fn)
+        return sorted(shards[index])
+
+    def write_manifest(self):
+        '''Write self.manifest as json.'''
+        fn = self.manifest_fn
+        if not fn:
+            index, count = self.manifest['shard']
+            fn = os.path.join(self.output_directory,
+                'py2cs-manifest-%s-of-%s.json' % (index + 1, count))
+        f, tmp_fn = self.open_temp_file(fn)
+        json.dump(self.manifest, f, indent=1, sort_keys=True)
+        f.close()
+        replace_file(tmp_fn, fn)
+        self.message('manifest: %s' % fn)
+
+    def merge_manifest_files(self, files):
+        '''
+        Merge the manifests of all shards. Report missing, extra and
+        duplicate shards and inputs, and outputs written by more than one
+        input. Write the merged manifest to self.manifest_fn, if given.
+        '''
+        errors, manifests = [], []
+        for fn in files:
+            try:
+                f = open(fn)
+                manifests.append(json.load(f))
+                f.close()
+            except (IOError, ValueError) as e:
+                errors.append('bad manifest: %s: %s' % (fn, e))
+        if not manifests:
+            errors.append('no manifests')
+        else:
+            errors.extend(self.check_manifests(manifests))
+        for z in errors:
+            print(z)
+        if errors:
+            self.exit_status = 1
+            return
+        merged = {
+            'version': 1,
+            'shard': [0, 1],
+            'all_inputs': manifests[0]['all_inputs'],
+            'all_inputs_sha1': manifests[0]['all_inputs_sha1'],
+            'inputs': dict(sum([list(z['inputs'].items()) for z in manifests], [])),
+            'output_directory': manifests[0]['output_directory'],
+            'files': sorted(sum([z['files'] for z in manifests], []),
+                key=lambda d: d['input']),
+        }
+        print('merged %s manifests: %s inputs, %s converted' % (
+            len(manifests), len(merged['inputs']), len(merged['files'])))
+        if self.manifest_fn:
+            self.manifest = merged
+            self.write_manifest()
+
+    def check_manifests(self, manifests):
+        '''Return a list of error messages for a list of shard manifests.'''
+        errors = []
+        counts = set([z['shard'][1] for z in manifests])
+        hashes = set([z['all_inputs_sha1'] for z in manifests])
+        if len(counts) > 1 or len(hashes) > 1:
+            return ['manifests come from different runs']
+        count = counts.pop()
+        indices = sorted([z['shard'][0] for z in manifests])
+        for i in range(count):
+            n = indices.count(i)
+            if n != 1:
+                errors.append('%s manifests for shard %s/%s' % (n or 'no', i + 1, count))
+        seen = set()
+        for z in sum([list(z['inputs']) for z in manifests], []):
+            if z in seen:
+                errors.append('input in more than one shard: %s' % z)
+            seen.add(z)
+        all_inputs = manifests[0]['all_inputs']
+        if len(seen) != all_inputs or string_sha1('\n'.join(sorted(seen))) != hashes.pop():
+            errors.append('shards cover %s of %s inputs' % (len(seen), all_inputs))
+        outputs = {}
+        for z in manifests:
+            for fn, out_fn in z['inputs'].items():
+                if out_fn:
+                    outputs.setdefault(out_fn, []).append(fn)
+        for out_fn in sorted(outputs):
+            if len(outputs[out_fn]) > 1:
+                errors.append('output collision: %s from %s' % (
+                    out_fn, ', '.join(sorted(outputs[out_fn]))))
+        return errors
+
+    def changed_files(self, patterns):
+        '''
+        Return the list of python files added, modified or renamed since
+        git revision self.since, or None if git fails. Remove the .coffee
+        files of deleted python files and rename those of renamed files.
+
+        Changes are those between self.since and the working tree, so
+        uncommitted changes count. Untracked files do not.
+
+        If patterns is not empty, return only files matching a pattern or
+        inside a directory in patterns.
+        '''
+        try:
+            top = self.git('rev-parse', '--show-toplevel').strip()
+            out = self.git('diff', '--name-status', '-z', '-M', self.since, '--')
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('--since %s: git failed: %s' % (self.since, e))
+            return None
+
+        def matches(fn):
+            if not fn.endswith('.py'):
+                return False
+            for pattern in patterns:
+                if fn.startswith(pattern.rstrip(os.sep) + os.sep):
+                    return True
+                if fnmatch.fnmatch(fn, pattern):
+                    return True
+            return not patterns
+
+        fields = out.split('\0')
+        result, i = [], 0
+        while i < len(fields) and fields[i]:
+            status = fields[i][0]
+            if status in 'RC':
+                old_fn, fn = fields[i+1], fields[i+2]
+                i += 3
+            else:
+                old_fn = fn = fields[i+1]
+                i += 2
+            old_fn = self.finalize(os.path.join(top, old_fn))
+            fn = self.finalize(os.path.join(top, fn))
+            if status == 'D':
+                if matches(fn):
+                    self.remove_coffeescript_file(fn)
+            elif status == 'R' and matches(old_fn):
+                if matches(fn):
+                    self.rename_coffeescript_file(old_fn, fn)
+                    result.append(fn)
+                else:
+                    self.remove_coffeescript_file(old_fn)
+            elif matches(fn):
+                result.append(fn)
+        return sorted(result)
+
+    def run_git_rev(self):
+        '''
+        Convert the python files of git revision self.git_rev, reading them
+        with 'git cat-file --batch'. Nothing is checked out.
+
+        Results are cached by blob id in the .py2cs-blobs directory, so
+        identical files in any revision are converted only once.
+        '''
+        rev = self.git_rev
+        paths = [os.path.relpath(z) for z in self.files]
+        try:
+            out = self.git('ls-tree', '-r', '-z', rev, '--', *paths)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('--git-rev %s: git failed: %s' % (rev, e))
+            self.exit_status = 1
+            return
+        blobs = []
+        for line in out.split('\0'):
+            if line:
+                meta, path = line.split('\t', 1)
+                mode, kind, sha = meta.split()
+                if kind == 'blob' and path.endswith('.py'):
+                    blobs.append((sha, path))
+        cache_dir = os.path.join(self.output_directory, '.py2cs-blobs')
+        if not self.check:
+            if os.path.isfile(cache_dir):
+                os.remove(cache_dir) # The single-file cache of older versions.
+            if not os.path.exists(cache_dir):
+                os.mkdir(cache_dir)
+        version = self.blob_cache_version, script_sha1()
+        options = self.options_key()
+        proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for sha, path in blobs:
+                out_fn = self.coffee_file_name(path)
+                if self.check_output_file(out_fn):
+                    cache_fn = os.path.join(cache_dir, sha + options.replace(':', '-'))
+                    result = self.load_pickle(cache_fn, version)
+                    fn = '%s:%s' % (rev, path)
+                    if result is None:
+                        self.metrics.inc('cache_misses', cache='blob')
+                        try:
+                            s = self.read_blob(proc, sha)
+                        except (IOError, SyntaxError, UnicodeDecodeError) as e:
+                            self.fail_file(fn, 'can not read: %s' % e)
+                        else:
+                            result = self.convert_file(fn, out_fn, s)
+                            if result is not None and not self.check:
+                                self.save_pickle(cache_fn, result, version)
+                    else:
+                        self.metrics.inc('cache_hits', cache='blob')
+                        if not self.check:
+                            os.utime(cache_fn, None) # Mark the entry as recently used.
+                    if result is not None:
+                        self.write_result(fn, out_fn, result)
+        finally:
+            proc.stdin.close()
+            proc.wait()
+        if not self.check:
+            self.prune_cache(cache_dir, self.blob_cache_size)
+
+    def is_archive_input(self, fn):
+        '''Return True if fn is a zip file, wheel or tar file.'''
+        return fn.endswith(('.zip', '.whl', '.tar', '.tar.gz', '.tgz', '.tar.bz2'))
+
+    def convert_archive(self, fn):
+        '''
+        Convert all python files in the archive fn without extracting it.
+        The .coffee files mirror the paths of the python files in the archive.
+        '''
+        try:
+            for name, data in self.archive_input_members(fn):
+                out_fn = self.member_file_name(name)
+                member_fn = '%s:%s' % (fn, name)
+                if not out_fn:
+                    self.skip_file('unsafe path', 'unsafe path %s' % member_fn, input=member_fn)
+                elif self.resume_file(member_fn):
+                    pass
+                elif self.check_member_file(out_fn):
+                    s = self.decode_source(data)
+                    result = self.convert_file(member_fn, out_fn, s)
+                    if result is not None:
+                        self.write_coffeescript_file(out_fn, result)
+                        self.finish_file(member_fn)
+        except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError) as e:
+            self.fail_file(fn, 'can not read: %s' % e)
+
+    def check_member_file(self, out_fn):
+        '''
+        Return True if the .coffee file of an archive member may be written,
+        creating its directory if necessary.
+        '''
+        dir_ = os.path.dirname(out_fn)
+        if not (self.archive or self.check) and not os.path.exists(dir_):
+            os.makedirs(dir_)
+        return self.check_output_file(out_fn)
+
+    def archive_input_members(self, fn):
+        '''
+        Yield (name, data) for all python files in the archive fn.
+        Tar files are read as a stream, one member at a time.
+        '''
+        if fn.endswith(('.zip', '.whl')):
+            archive = zipfile.ZipFile(fn)
+            try:
+                for info in archive.infolist():
+                    if info.filename.endswith('.py'):
+                        yield info.filename, archive.read(info)
+            finally:
+                archive.close()
+        else:
+            archive = tarfile.open(fn, 'r|*')
+            try:
+                for info in archive:
+                    if info.isfile() and info.name.endswith('.py'):
+                        f = archive.extractfile(info)
+                        data = f.read()
+                        f.close()
+                        yield info.name, data
+            finally:
+                archive.close()
+
+    def member_file_name(self, name):
+        '''
+        Return the full path to the .coffee file for the archive member name,
+        or None if name is not a relative path inside the archive.
+        '''
+        path = os.path.normpath(name.replace('/', os.sep))
+        if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+            return None
+        out_fn = os.path.join(self.output_directory, path)
+        return out_fn[: -3] + '.coffee'
+
+    def convert_leo_file(self, fn):
+        '''
+        Convert the python files of all @file and @clean trees in the Leo
+        outline fn, without writing the python files.
+
+        An outline holds only the headline of an @file tree, so its python
+        file is read from disk, without Leo's sentinel lines.
+        '''
+        try:
+            nodes, roots, bodies = self.parse_leo_file(fn)
+        except (IOError, OSError, SyntaxError) as e:
+            # ElementTree.ParseError is a subclass of SyntaxError.
+            self.fail_file(fn, 'can not read: %s' % e)
+            return
+        for gnx, kind, path in roots:
+            out_fn = self.coffee_file_name(path)
+            member_fn = path if kind == 'file' else '%s:%s' % (fn, path)
+            if self.resume_file(member_fn):
+                pass
+            elif self.check_output_file(out_fn):
+                if kind == 'file':
+                    try:
+                        f = open(path)
+                        s = self.strip_leo_sentinels(f.read())
+                        f.close()
+                    except IOError as e:
+                        self.fail_file(member_fn, 'can not read @file tree: %s' % e)
+                        continue
+                else:
+                    lines = []
+                    self.put_leo_body(gnx, '', nodes, bodies, lines)
+                    s = ''.join(lines)
+                result = self.convert_file(member_fn, out_fn, s)
+                if result is not None:
+                    self.write_coffeescript_file(out_fn, result)
+                    self.finish_file(member_fn)
+
+    def parse_leo_file(self, fn):
+        '''
+        Parse the Leo outline fn in a single streaming pass. Return
+        (nodes, roots, bodies), where:
+        nodes maps gnx's to (headline, list of child gnx's),
+        roots is a list of (gnx, kind, path) for all @file and @clean python
+        files, kind is 'file' or 'clean', and the path of an @file tree is
+        the full path of its python file,
+        bodies maps the gnx's of all nodes in @clean trees to their body text.
+        '''
+        nodes, roots, bodies = {}, [], {}
+        paths = {} # Maps gnx's to the values of @path directives in bodies.
+        stack = [] # The gnx's of the open <v> elements.
+        needed = None # The gnx's of all nodes in @clean trees.
+        for event, elem in ElementTree.iterparse(fn, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'v':
+                    gnx = elem.get('t')
+                    if stack:
+                        nodes[stack[-1]][1].append(gnx)
+                    # A clone's children are written only once.
+                    nodes.setdefault(gnx, ['', []])
+                    stack.append(gnx)
+            elif tag == 'vh':
+                nodes[stack[-1]][0] = elem.text or ''
+            elif tag == 'v':
+                gnx = stack.pop()
+                m = re.match(r'@(file|clean)\s+(.+\.py)\s*$', nodes[gnx][0])
+                if m:
+                    roots.append((gnx, m.group(1), m.group(2)))
+                elem.clear()
+            elif tag == 'vnodes':
+                needed = set()
+                for gnx, kind, path in roots:
+                    if kind == 'clean':
+                        self.leo_subtree(gnx, nodes, needed)
+            elif tag == 't':
+                gnx = elem.get('tx')
+                if needed and gnx in needed:
+                    bodies[gnx] = elem.text or ''
+                m = re.search(r'^@path\s+(.+?)\s*$', elem.text or '', re.M)
+                if m:
+                    paths[gnx] = m.group(1)
+                elem.clear()
+        parents = {}
+        for gnx in nodes:
+            for child in nodes[gnx][1]:
+                parents.setdefault(child, gnx)
+        for i, (gnx, kind, path) in enumerate(roots):
+            if kind == 'file':
+                # @path directives in ancestors are relative to the outline.
+                while gnx in parents:
+                    gnx = parents[gnx]
+                    m = re.match(r'@path\s+(.+?)\s*$', nodes[gnx][0])
+                    path = os.path.join(m.group(1) if m else paths.get(gnx, ''), path)
+                path = os.path.join(os.path.dirname(os.path.abspath(fn)), path)
+                roots[i] = roots[i][0], kind, os.path.normpath(path)
+        return nodes, roots, bodies
+
+    def strip_leo_sentinels(self, s):
+        '''Remove Leo's sentinel lines from the text s of an @file tree.'''
+        lines, verbatim = [], False
+        for line in g.splitLines(s):
+            if verbatim:
+                lines.append(line)
+                verbatim = False
+            elif line.lstrip().startswith('#@'):
+                verbatim = line.strip() == '#@verbatim'
+            else:
+                lines.append(line)
+        return ''.join(lines)
+
+    def leo_subtree(self, gnx, nodes, result):
+        '''Add gnx and the gnx's of all its descendants to the result set.'''
+        if gnx not in result:
+            result.add(gnx)
+            for child in nodes[gnx][1]:
+                self.leo_subtree(child, nodes, result)
+
+    def put_leo_body(self, gnx, indent, nodes, bodies, lines):
+        '''
+        Append the lines of the body of node gnx to lines, indented by indent,
+        expanding @others and section references as Leo does when writing
+        @clean files. Return True if the body contains @others.
+        '''
+        directives = (
+            'all|beautify|code|c|color|comment|delims|doc|encoding|first|'
+            'ignore|killcolor|language|last|lineending|nobeautify|nocolor|'
+            'nocolor-node|nopyflakes|nosearch|nowrap|others|pagewidth|path|'
+            'raw|end_raw|tabwidth|wrap')
+        body = bodies.get(gnx, '')
+        if body and not body.endswith('\n'):
+            body += '\n'
+        has_others, in_doc = False, False
+        for line in g.splitLines(body):
+            s = line.lstrip(' \t')
+            ws = indent + line[: len(line) - len(s)]
+            m = re.match(r'@(%s)(?=\s|$)' % directives, s)
+            name = m.group(1) if m else None
+            ref = re.search(r'<<\s*(.+?)\s*>>', s)
+            if in_doc:
+                if name in ('c', 'code'):
+                    in_doc = False
+                else:
+                    lines.append(ws + '# ' + s)
+            elif s in ('@\n', '@') or s.startswith('@ ') or name == 'doc':
+                in_doc = True
+                rest = s[1:].strip() if name != 'doc' else s[4:].strip()
+                if rest:
+                    lines.append(ws + '# ' + rest + '\n')
+            elif name == 'others':
+                self.put_leo_others(gnx, ws, nodes, bodies, lines)
+                has_others = True
+            elif name == 'first':
+                lines.append(s[len('@first'):].lstrip(' \t'))
+            elif name:
+                pass # Other directives are not written.
+            elif ref and self.find_leo_section(gnx, ref.group(1), nodes):
+                section = self.find_leo_section(gnx, ref.group(1), nodes)
+                self.put_leo_body(section, ws, nodes, bodies, lines)
+            elif line.strip('\n'):
+                lines.append(indent + line)
+            else:
+                lines.append(line)
+        return has_others
+
+    def put_leo_others(self, gnx, indent, nodes, bodies, lines):
+        '''
+        Append the expansion of @others in node gnx: the bodies of all
+        descendants that are not sections and are not written by the @others
+        directive of another descendant.
+        '''
+        for child in nodes[gnx][1]:
+            if not self.is_leo_section(nodes[child][0]):
+                if not self.put_leo_body(child, indent, nodes, bodies, lines):
+                    self.put_leo_others(child, indent, nodes, bodies, lines)
+
+    def is_leo_section(self, headline):
+        '''Return the section name if headline defines a section, else None.'''
+        m = re.match(r'<<\s*(.+?)\s*>>', headline.strip())
+        return m.group(1) if m else None
+
+    def find_leo_section(self, gnx, name, nodes):
+        '''Return the gnx of the definition of section name in gnx's subtree.'''
+        for child in nodes[gnx][1]:
+            if self.is_leo_section(nodes[child][0]) == name:
+                return child
+            found = self.find_leo_section(child, name, nodes)
+            if found:
+                return found
+        return None
+
+    def options_key(self):
+        '''Return a string describing all options that affect the output.'''
+        return ':%s' % string_sha1(repr((self.strip_comments, sorted(self.only))))
+
+    def read_blob(self, proc, sha):
+        '''Return the decoded source of a blob read from 'git cat-file --batch'.'''
+        proc.stdin.write(sha.encode('ascii') + b'\n')
+        proc.stdin.flush()
+        header = proc.stdout.readline().split()
+        if len(header) != 3:
+            raise IOError('git cat-file: missing object %s' % sha)
+        data = proc.stdout.read(int(header[2]))
+        proc.stdout.read(1) # The trailing newline.
+        return self.decode_source(data)
+
+    def decode_source(self, data):
+        '''Decode the bytes of a python source file, as open().read() would.'''
+        if isPython3:
+            readline = io.BytesIO(data).readline
+            encoding = tokenize.detect_encoding(readline)[0]
+            data = data.decode(encoding)
+            if data.startswith('\ufeff'):
+                data = data[1:]
+        return data.replace('\r\n', '\n').replace('\r', '\n')
+
+    def git(self, *args):
+        '''Run git with the given arguments and return its output.'''
+        out = subprocess.check_output(('git',) + args)
+        return out.decode('utf-8') if isPython3 else out
+
+    def remove_coffeescript_file(self, fn):
+        '''Remove the .coffee file of deleted python file fn.'''
+        out_fn = self.coffee_file_name(fn)
+        if os.path.exists(out_fn) and self.check:
+            self.stale_file(out_fn, 'python file deleted')
+        elif os.path.exists(out_fn):
+            os.remove(out_fn)
+            self.message('removed: %s' % out_fn)
+
+    def rename_coffeescript_file(self, old_fn, fn):
+        '''Rename the .coffee file of a python file renamed from old_fn to fn.'''
+        old_out_fn = self.coffee_file_name(old_fn)
+        out_fn = self.coffee_file_name(fn)
+        if old_out_fn != out_fn and os.path.exists(old_out_fn) and not self.check:
+            replace_file(old_out_fn, out_fn)
+            self.message('renamed: %s -> %s' % (old_out_fn, out_fn))
+
     def run_all_unit_tests(self):
         '''Run all unit tests in the python-to-coffeescript/test directory.'''
         import unittest
@@ -1247,19 +3649,158 @@ class MakeCoffeeScriptController(object):
         add = parser.add_option
         add('-c', '--config', dest='fn',
             help='full path to configuration file')
+        add('--bundle-by', dest='bundle_by', metavar='KIND',
+            help='write one .coffee file per package or directory')
+        add('--check', action='store_true', default=False,
+            help='report stale .coffee files without writing anything')
         add('-d', '--dir', dest='dir',
             help='full path to the output directory')
+        add('--diff', action='store_true', default=False,
+            help='like --check, and show the differences')
+        add('-i', '--incremental', action='store_true', default=False,
+            help='reconvert only changed statements')
+        add('--explain', dest='explain', metavar='FILE',
+            help='show where the time converting FILE is spent')
+        add('--file-max-rss', dest='file_max_rss', type='int', metavar='MB',
+            help='stop converting any file after using MB megabytes')
+        add('--file-timeout', dest='file_timeout', type='float', metavar='SECONDS',
+            help='stop converting any file after SECONDS seconds')
+        add('--front-end-cache', dest='front_end_cache', metavar='DIR',
+            help='cache the tokens of all sources in directory DIR')
+        add('--front-end-cache-size', dest='front_end_cache_size', type='int',
+            default=100, metavar='MB', help='limit the front-end cache to MB megabytes')
+        add('--git-rev', dest='git_rev', metavar='REV',
+            help='convert the python files of git revision REV')
+        add('--io-threads', dest='io_threads', type='int', default=0, metavar='N',
+            help='read and write files in N background threads')
+        add('-j', '--jobs', dest='jobs', type='int', default=1, metavar='N',
+            help='convert large files using N worker processes')
+        add('--only', dest='only', metavar='NAMES',
+            help='convert only the named classes and functions')
+        add('--journal', dest='journal', metavar='FN',
+            help='record completed files in journal FN')
+        add('--log', dest='log', metavar='FN',
+            help='write structured events as JSON lines to FN')
+        add('--log-level', dest='log_level', metavar='LEVEL',
+            help='log events of LEVEL: error, warning, info or debug')
+        add('-m', '--manifest', dest='manifest', metavar='FN',
+            help='write a manifest of the conversion to FN')
+        add('--metrics', dest='metrics', metavar='FN',
+            help='write metrics to FN (Prometheus textfile if FN ends with .prom)')
+        add('--max-source-size', dest='max_source_size', type='int', metavar='BYTES',
+            help='do not convert files larger than BYTES bytes')
+        add('--merge-manifests', action='store_true', default=False,
+            help='merge and check the shard manifests given as files')
         add('-o', '--overwrite', action='store_true', default=False,
             help='overwrite existing .coffee files')
         # add('-t', '--test', action='store_true', default=False,
             # help='run unit tests on startup')
+        add('--output-archive', dest='output_archive', metavar='FN',
+            help='write all .coffee files to the .zip, .tar or .tar.gz file FN')
+        add('--profile', dest='profile', metavar='OUT',
+            help='write profiles of all conversions to OUT.pstats and OUT.collapsed')
+        add('-r', '--resume', action='store_true', default=False,
+            help='skip files completed by the run recorded in the journal')
+        add('--shard', dest='shard', metavar='INDEX/COUNT',
+            help='convert only the files of shard INDEX (1-based) of COUNT')
+        add('--since', dest='since', metavar='REV',
+            help='convert only python files changed since git revision REV')
+        add('-s', '--strip-comments', action='store_true', default=False,
+            help='omit comments and blank lines')
+        add('-t', '--threads', dest='threads', type='int', default=1, metavar='N',
+            help='convert files in N threads')
         add('-v', '--verbose', action='store_true', default=False,
             help='verbose output')
         # Parse the options
         options, args = parser.parse_args()
         # Handle the options...
         # self.enable_unit_tests = options.test
+        self.incremental = options.incremental
+        self.io_threads = max(0, options.io_threads)
+        self.jobs = max(1, options.jobs)
+        self.threads = max(1, options.threads)
+        if options.only:
+            self.only = [z.strip() for z in options.only.split(',') if z.strip()]
         self.overwrite = options.overwrite
+        self.check = options.check or options.diff
+        self.show_diffs = options.diff
+        self.strip_comments = options.strip_comments
+        self.merge_manifests = options.merge_manifests
+        self.resume = options.resume
+        self.file_max_rss = options.file_max_rss
+        self.file_timeout = options.file_timeout
+        self.max_source_size = options.max_source_size
+        if (self.file_timeout or self.file_max_rss) and (self.incremental or self.jobs > 1):
+            # The worker process has no statement cache and no pool.
+            print('--file-timeout and --file-max-rss can not be used with --incremental or --jobs')
+            print('exiting')
+            sys.exit(1)
+        if options.journal:
+            self.journal_fn = self.finalize(options.journal)
+        self.git_rev = options.git_rev
+        if options.since:
+            # Changed files are always reconverted.
+            self.since = options.since
+            self.overwrite = True
+        if options.manifest:
+            self.manifest_fn = self.finalize(options.manifest)
+        if options.bundle_by:
+            if options.bundle_by not in ('package', 'directory'):
+                print('--bundle-by: expected package or directory: %s' % options.bundle_by)
+                print('exiting')
+                sys.exit(1)
+            self.bundle_by = options.bundle_by
+        if options.log_level or options.log:
+            level = options.log_level or 'info'
+            if level not in log_levels:
+                print('--log-level: expected one of %s: %s' % (
+                    ', '.join(sorted(log_levels, key=log_levels.get)), level))
+                print('exiting')
+                sys.exit(1)
+            self.log_level = log_levels[level]
+            if options.log:
+                self.log_file = open(self.finalize(options.log), 'a')
+        if options.metrics:
+            self.metrics_fn = self.finalize(options.metrics)
+            self.metrics.enabled = True
+        if options.explain:
+            self.explain_fn = self.finalize(options.explain)
+        if options.front_end_cache:
+            self.front_end_cache = self.finalize(options.front_end_cache)
+            self.front_end_cache_size = max(0, options.front_end_cache_size)
+        if options.profile and self.threads > 1:
+            print('--profile can not be used with --threads')
+            print('exiting')
+            sys.exit(1)
+        if options.profile:
+            fn = self.finalize(options.profile)
+            self.profile_fn = fn if fn.endswith('.pstats') else fn + '.pstats'
+        if options.output_archive:
+            fn = self.finalize(options.output_archive)
+            if not fn.endswith(('.zip', '.tar', '.tar.gz', '.tgz')):
+                print('--output-archive: expected a .zip, .tar or .tar.gz file: %s' % fn)
+                print('exiting')
+                sys.exit(1)
+            self.output_archive = fn
+            if self.check:
+                print('--output-archive can not be used with --check or --diff')
+                print('exiting')
+                sys.exit(1)
+        if options.shard:
+            try:
+                index, count = [int(z) for z in options.shard.split('/')]
+            except ValueError:
+                index, count = 0, 0
+            if not 1 <= index <= count:
+                print('--shard: expected INDEX/COUNT with 1 <= INDEX <= COUNT: %s' % options.shard)
+                print('exiting')
+                sys.exit(1)
+            self.shard = index - 1, count
+            if self.bundle_by:
+                # Shards partition files, which would split bundles.
+                print('--shard can not be used with --bundle-by')
+                print('exiting')
+                sys.exit(1)
         if options.fn:
             self.config_fn = options.fn
         if options.dir:
@@ -1285,19 +3826,21 @@ class MakeCoffeeScriptController(object):
         self.parser = parser = self.create_parser()
         s = self.get_config_string()
         self.init_parser(s)
+        has_jobs = any([self.is_job_section(z) for z in parser.sections()])
         if self.files:
+            if has_jobs:
+                print('ignoring jobs: files given on the command line')
             files_source = 'command-line'
             files = self.files
-        elif parser.has_section('Global'):
+        elif has_jobs:
+            self.config_jobs = self.scan_jobs()
+            return
+        elif parser.has_section('Global') and 'files' in parser.options('Global'):
             files_source = 'config file'
-            files = parser.get('Global', 'files')
-            files = [z.strip() for z in files.split('\n') if z.strip()]
+            files = self.config_files(parser.get('Global', 'files'))
         else:
             return
-        files2 = []
-        for z in files:
-            files2.extend(glob.glob(self.finalize(z)))
-        self.files = [z for z in files2 if z and os.path.exists(z)]
+        self.files = self.expand_files(files)
         if trace:
             print('Files (from %s)...\n' % files_source)
             for z in self.files:
@@ -1327,6 +3870,81 @@ class MakeCoffeeScriptController(object):
         # self.general_patterns = self.scan_patterns('General Patterns')
         # self.make_patterns_dict()
 
+    def config_files(self, s):
+        '''Return the list of file names in the files option s.'''
+        return [z.strip() for z in s.split('\n') if z.strip()]
+
+    def expand_files(self, files):
+        '''Return the list of existing files matching the patterns in files.'''
+        if self.since or self.git_rev:
+            # The patterns filter git's list of files, not the working tree.
+            return [self.finalize(z) for z in files]
+        files2 = []
+        for z in files:
+            files2.extend(glob.glob(self.finalize(z)))
+        return [z for z in files2 if z and os.path.exists(z)]
+
+    def is_job_section(self, name):
+        '''Return True if name is the name of a [Job NAME] section.'''
+        return name.lower().startswith('job ') and bool(name[4:].strip())
+
+    def scan_jobs(self):
+        '''
+        Return a list of (name, ivars) tuples, one for each [Job NAME]
+        section of the configuration file. Options missing from a section
+        default to those of the command line and the Global section.
+        '''
+        parser = self.parser
+        if self.git_rev or self.merge_manifests or self.output_archive or (
+            self.manifest_fn or self.shard or self.journal_fn
+        ):
+            print('jobs can not be used with --git-rev, --merge-manifests, '
+                '--output-archive, --manifest, --shard or --journal')
+            print('exiting')
+            sys.exit(1)
+        files, output_dir = [], self.output_directory
+        if parser.has_section('Global'):
+            if 'files' in parser.options('Global'):
+                files = self.config_files(parser.get('Global', 'files'))
+            if 'output_directory' in parser.options('Global'):
+                output_dir = self.finalize(parser.get('Global', 'output_directory'))
+        jobs = []
+        for section in parser.sections():
+            if self.is_job_section(section):
+                name = section[4:].strip()
+                options = parser.options(section)
+                ivars = {
+                    'files': files,
+                    'incremental': self.incremental,
+                    'only': self.only,
+                    'output_directory': output_dir,
+                    'overwrite': self.overwrite,
+                    'strip_comments': self.strip_comments,
+                }
+                try:
+                    if 'files' in options:
+                        ivars['files'] = self.config_files(parser.get(section, 'files'))
+                    ivars['files'] = self.expand_files(ivars['files'])
+                    if 'output_directory' in options:
+                        ivars['output_directory'] = self.finalize(
+                            parser.get(section, 'output_directory'))
+                    if 'only' in options:
+                        ivars['only'] = [z.strip() for z in
+                            parser.get(section, 'only').split(',') if z.strip()]
+                    for key in ('incremental', 'overwrite', 'strip_comments'):
+                        if key in options:
+                            ivars[key] = parser.getboolean(section, key)
+                except ValueError as e:
+                    print('[%s]: %s' % (section, e))
+                    print('exiting')
+                    sys.exit(1)
+                if ivars['incremental'] and (self.file_timeout or self.file_max_rss):
+                    print('[%s]: incremental can not be used with budgets' % section)
+                    print('exiting')
+                    sys.exit(1)
+                jobs.append((name, ivars))
+        return jobs
+
     def create_parser(self):
         '''Create a RawConfigParser and return it.'''
         parser = configparser.RawConfigParser()
@@ -1372,6 +3990,8 @@ class MakeCoffeeScriptController(object):
 
         s = s.strip()
         if s.startswith('[') and s.endswith(']'):
+            if self.is_job_section(s[1: -1].strip()):
+                return True
             s = munge(s[1: -1])
             for s2 in self.section_names:
                 if s == munge(s2):
@@ -1379,6 +3999,87 @@ class MakeCoffeeScriptController(object):
         return False
 
 
+class Metrics(object):
+    '''Counters and histograms describing a run, for production monitoring.'''
+
+    def __init__(self, enabled=True):
+        '''Ctor for Metrics class.'''
+        self.enabled = enabled # False: inc and observe do nothing.
+        self.buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+        self.counters = {} # Keys are (name, labels) tuples.
+        self.histograms = {} # Values are [bucket counts, sum, count].
+        self.help = {
+            'bytes': 'Bytes of python read and coffeescript written.',
+            'cache_hits': 'Results reused from a cache.',
+            'cache_misses': 'Results not found in a cache.',
+            'conversion_seconds': 'Time taken to convert one file.',
+            'files': 'Files converted or failed.',
+            'files_skipped': 'Files not converted.',
+            'sync_warnings': 'Problems syncing the parse tree with the tokens.',
+        }
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        '''Add value to the counter with the given name and labels.'''
+        if not self.enabled:
+            return
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        '''Add value to the histogram with the given name.'''
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms.get(name)
+            if not h:
+                h = self.histograms[name] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def to_json(self):
+        '''Return a dict describing all metrics.'''
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        histograms = {}
+        for name, (counts, total, n) in sorted(self.histograms.items()):
+            histograms[name] = {'buckets': list(zip(self.buckets, counts)),
+                'sum': round(total, 6), 'count': n}
+        return {'time': round(time.time(), 6),
+            'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        '''Return all metrics in the Prometheus text exposition format.'''
+        result, seen = [], set()
+
+        def labels_string(labels):
+            return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('"', '\\"'))
+                for k, v in labels]) if labels else ''
+
+        for (name, labels), value in sorted(self.counters.items()):
+            full_name = 'py2cs_%s_total' % name
+            if name not in seen:
+                seen.add(name)
+                result.append('# HELP %s %s' % (full_name, self.help.get(name, name)))
+                result.append('# TYPE %s counter' % full_name)
+            result.append('%s%s %s' % (full_name, labels_string(labels), value))
+        for name, (counts, total, n) in sorted(self.histograms.items()):
+            full_name = 'py2cs_%s' % name
+            result.append('# HELP %s %s' % (full_name, self.help.get(name, name)))
+            result.append('# TYPE %s histogram' % full_name)
+            for bound, count in zip(self.buckets, counts):
+                result.append('%s_bucket{le="%s"} %s' % (full_name, bound, count))
+            result.append('%s_bucket{le="+Inf"} %s' % (full_name, n))
+            result.append('%s_sum %s' % (full_name, round(total, 6)))
+            result.append('%s_count %s' % (full_name, n))
+        return '\n'.join(result) + '\n'
+
+
 class ParseState(object):
     '''A class representing items parse state stack.'''
 
@@ -1396,18 +4097,33 @@ class TokenSync(object):
     '''A class to sync and remember tokens.'''
     # To do: handle comments, line breaks...
 
-    def __init__(self, s, tokens):
-        '''Ctor for TokenSync class.'''
+    def __init__(self, s, tokens, comments=True, warning=None):
+        '''
+        Ctor for TokenSync class.
+        If comments is False, comments and blank lines are never returned.
+        warning(event, line, s), if given, reports sync problems.
+        '''
         assert isinstance(tokens, list) # Not a generator.
         self.s = s
+        self.comments = comments
+        self.warning = warning
         self.first_leading_line = None
         self.lines = [z.rstrip() for z in g.splitLines(s)]
         # Order is important from here on...
         self.nl_token = self.make_nl_token()
         self.line_tokens = self.make_line_tokens(tokens)
-        self.blank_lines = self.make_blank_lines()
         self.string_tokens = self.make_string_tokens()
-        self.ignored_lines = self.make_ignored_lines()
+        if comments:
+            self.blank_lines = self.make_blank_lines()
+            self.ignored_lines = self.make_ignored_lines()
+        else:
+            self.blank_lines, self.ignored_lines = [], []
+            self.first_leading_line = 0
+            # Redirect the comment-related methods.
+            self.leading_lines = self.no_leading_lines
+            self.leading_string = self.no_leading_string
+            self.trailing_comment = self.no_trailing_comment
+            self.trailing_comment_at_lineno = self.no_trailing_comment
 
     def make_blank_lines(self):
         '''Return of list of line numbers of blank lines.'''
@@ -1484,7 +4200,10 @@ class TokenSync(object):
     def check_strings(self):
         '''Check that all strings have been consumed.'''
         for i, aList in enumerate(self.string_tokens):
-            if aList:
+            if aList and self.warning:
+                self.warning('unused strings', i,
+                    ' '.join([self.dump_token(z) for z in aList]))
+            elif aList:
                 g.trace('warning: line %s. unused strings' % i)
                 for z in aList:
                     print(self.dump_token(z))
@@ -1503,6 +4222,17 @@ class TokenSync(object):
             else:
                 return val
 
+    def first_line(self, lineno):
+        '''
+        Return the zero-based first line of the statement at the given lineno.
+        Strings ending on that line may start on an earlier line.
+        '''
+        n = lineno - 1
+        for token in self.line_tokens[n]:
+            if self.token_kind(token) == 'string':
+                n = min(n, token[2][0] - 1)
+        return n
+
     def is_line_comment(self, token):
         '''Return True if the token represents a full-line comment.'''
         t1, t2, t3, t4, t5 = token
@@ -1522,6 +4252,8 @@ class TokenSync(object):
     def last_node(self, node):
         '''Return the node of node's tree with the largest lineno field.'''
 
+        node_lineno = self.node_lineno
+
         class LineWalker(ast.NodeVisitor):
             
             def __init__ (self):
@@ -1532,8 +4264,9 @@ class TokenSync(object):
             def visit(self, node):
                 '''LineWalker.visit.'''
                 if hasattr(node, 'lineno'):
-                    if node.lineno > self.lineno:
-                        self.lineno = node.lineno
+                    n = node_lineno(node)
+                    if n > self.lineno:
+                        self.lineno = n
                         self.node = node
                 if isinstance(node, list):
                     for z in node:
@@ -1586,15 +4319,40 @@ class TokenSync(object):
         else:
             return self.lines[n-1]
 
+    def no_leading_lines(self, node):
+        '''Return an empty list: comments are being stripped.'''
+        return []
+
+    def no_leading_string(self, node):
+        '''Return an empty string: comments are being stripped.'''
+        return ''
+
+    def no_trailing_comment(self, node_or_lineno):
+        '''Return a newline: comments are being stripped.'''
+        return '\n'
+
+    def node_lineno(self, node):
+        '''
+        Return node's line number as Python 3.7 and below report it: the
+        line number of a string is that of its last line.
+        '''
+        end = getattr(node, 'end_lineno', None)
+        if end and isinstance(getattr(node, 'value', None), (str, bytes)):
+            return end
+        return node.lineno
+
     def sync_string(self, node):
         '''Return the spelling of the string at the given node.'''
         # g.trace('%-10s %2s: %s' % (' ', node.lineno, self.line_at(node)))
-        n = node.lineno
+        n = self.node_lineno(node)
         tokens = self.string_tokens[n-1]
         if tokens:
             token = tokens.pop(0)
             self.string_tokens[n-1] = tokens
             return self.token_val(token)
+        elif self.warning:
+            self.warning('underflow', n, node.s)
+            return node.s
         else:
             g.trace('===== underflow line:', n, node.s)
             return node.s
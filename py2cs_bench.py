@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+'''
+Benchmarks for py2cs.py.
+
+Measures the conversion throughput of py2cs.py for the files listed on the
+command line (wildcard file names are supported). Nothing is written.
+
+py2cs_bench.py --threads N files... also compares converting the files in N
+threads with converting them in N processes.
+
+py2cs_bench.py compare OLD NEW files... compares the output and the speed
+of two versions of py2cs.py.
+
+For full details, see README.md.
+'''
+import ast
+import difflib
+import glob
+import math
+import multiprocessing
+import multiprocessing.pool
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tokenize
+import py2cs
+try:
+    import importlib.util as importlib_util # Python 3
+except ImportError:
+    import imp # Python 2
+    importlib_util = None
+# time.clock does not exist in Python 3.8 and above.
+clock = getattr(time, 'perf_counter', time.time)
+
+# Two-sided 95% critical values of Student's t distribution, by degrees of freedom.
+t_table = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042,
+}
+
+def main():
+    '''The driver for py2cs_bench.py.'''
+    if sys.argv[1:2] == ['compare']:
+        bench = Comparison()
+    else:
+        bench = Benchmark()
+    bench.scan_command_line()
+    bench.run()
+    sys.exit(bench.exit_status)
+
+def convert_source(data):
+    '''Convert one (fn, s) tuple in a worker process of the process pool.'''
+    fn, s = data
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return py2cs.MakeCoffeeScriptController().convert(fn, s)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def confidence_interval(values):
+    '''
+    Return (mean, low, high): the geometric mean of the positive values and
+    its 95% confidence interval.
+    '''
+    logs = [math.log(z) for z in values]
+    n = len(logs)
+    mean = sum(logs) / n
+    if n < 2:
+        return math.exp(mean), float('nan'), float('nan')
+    sd = math.sqrt(sum([(z - mean) ** 2 for z in logs]) / (n - 1))
+    df = n - 1
+    t = t_table.get(df) or t_table[max([z for z in t_table if z <= df])]
+    if df > 30:
+        t = 1.96
+    half = t * sd / math.sqrt(n)
+    return math.exp(mean), math.exp(mean - half), math.exp(mean + half)
+
+
+class Benchmark(object):
+    '''A class that times conversions of a corpus of python files.'''
+
+    def __init__(self):
+        '''Ctor for Benchmark class.'''
+        self.exit_status = 0
+        self.files = []
+        self.repeat = 3
+        self.sources = [] # List of (fn, s) tuples.
+        self.threads = 1
+
+    def convert_all(self, controller):
+        '''Convert all sources. Return the elapsed time.'''
+        t1 = clock()
+        for fn, s in self.sources:
+            controller.convert(fn, s)
+        return clock() - t1
+
+    def convert_in_processes(self, controller):
+        '''
+        Convert all sources in a pool of self.threads processes.
+        Return the elapsed time, including starting the pool.
+        '''
+        t1 = clock()
+        pool = multiprocessing.Pool(self.threads)
+        try:
+            pool.map(convert_source, self.sources, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return clock() - t1
+
+    def convert_in_threads(self, controller):
+        '''
+        Convert all sources in a pool of self.threads threads sharing
+        controller. Return the elapsed time, including starting the pool.
+        '''
+        t1 = clock()
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        try:
+            pool.map(lambda data: controller.convert(*data), self.sources, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return clock() - t1
+
+    def make_controller(self, **kwargs):
+        '''Return a controller whose ivars are set from kwargs.'''
+        controller = py2cs.MakeCoffeeScriptController()
+        for key, value in kwargs.items():
+            setattr(controller, key, value)
+        return controller
+
+    def read_sources(self):
+        '''Read all files into self.sources.'''
+        for fn in self.files:
+            f = open(fn)
+            self.sources.append((fn, f.read()))
+            f.close()
+
+    def run(self):
+        '''Time the conversion of all files with and without comments.'''
+        self.read_sources()
+        if not self.sources:
+            print('no input files')
+            return
+        n_bytes = sum([len(s) for fn, s in self.sources])
+        n_lines = sum([len(py2cs.g.splitLines(s)) for fn, s in self.sources])
+        print('%s files, %s lines, %s bytes' % (len(self.sources), n_lines, n_bytes))
+        modes = [
+            ('default', {}, self.convert_all),
+            ('strip comments', {'strip_comments': True}, self.convert_all),
+        ]
+        if self.threads > 1:
+            # Threads scale only if the interpreter does not have a GIL.
+            gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+            print('%s threads and processes, GIL %s' % (
+                self.threads, 'enabled' if gil else 'disabled'))
+            modes.extend([
+                ('%s threads' % self.threads, {}, self.convert_in_threads),
+                ('%s processes' % self.threads, {}, self.convert_in_processes),
+            ])
+        base = None
+        for name, kwargs, convert in modes:
+            controller = self.make_controller(**kwargs)
+            # Report the best time of all repetitions.
+            t = min([self.time_silently(convert, controller) for i in range(self.repeat)])
+            base = base or t
+            print('%-16s %7.3f sec %9.0f lines/sec %6.2fx' % (
+                name, t, n_lines / t, base / t))
+
+    def scan_command_line(self):
+        '''Set ivars from command-line arguments.'''
+        usage = "usage: py2cs_bench.py [options] file1, file2, ..."
+        parser = optparse.OptionParser(usage=usage)
+        parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+            help='number of times to convert each file')
+        parser.add_option('-t', '--threads', dest='threads', type='int', default=1,
+            help='also convert all files in N threads and in N processes')
+        options, args = parser.parse_args()
+        self.repeat = max(1, options.repeat)
+        self.threads = max(1, options.threads)
+        for z in args:
+            self.files.extend(glob.glob(os.path.abspath(os.path.expanduser(z))))
+
+    def time_silently(self, convert, controller):
+        '''Return the time taken by convert(controller), suppressing all warnings.'''
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            return convert(controller)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+class Comparison(object):
+    '''
+    A class that compares the output and the speed of two versions of
+    py2cs.py, loaded in the same process.
+    '''
+
+    def __init__(self):
+        '''Ctor for Comparison class.'''
+        self.exit_status = 0
+        self.files = []
+        self.repeat = 5
+        self.show_diffs = False
+        self.versions = [] # List of (name, module) tuples.
+
+    def convert(self, module, fn, s):
+        '''
+        Convert s with the CoffeeScriptTraverser of module.
+        Return (result, seconds). result is None if the conversion failed.
+        '''
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        t1 = clock()
+        try:
+            readlines = module.g.ReadLinesClass(s).next
+            tokens = list(tokenize.generate_tokens(readlines))
+            node = ast.parse(s, filename=fn, mode='exec')
+            result = module.CoffeeScriptTraverser(controller=None).format(node, s, tokens)
+        except Exception:
+            result = None
+        finally:
+            t = clock() - t1
+            sys.stdout.close()
+            sys.stdout = stdout
+        return result, t
+
+    def compare_file(self, fn, s):
+        '''
+        Convert s with both versions self.repeat times, alternating their
+        order. Return (old, new, old_times, new_times), where old and new
+        are the results and old_times and new_times list the times of all
+        repetitions.
+        '''
+        (old_name, old_module), (new_name, new_module) = self.versions
+        old_times, new_times = [], []
+        for i in range(self.repeat):
+            if i % 2:
+                new, new_t = self.convert(new_module, fn, s)
+                old, old_t = self.convert(old_module, fn, s)
+            else:
+                old, old_t = self.convert(old_module, fn, s)
+                new, new_t = self.convert(new_module, fn, s)
+            old_times.append(max(old_t, 1e-9))
+            new_times.append(max(new_t, 1e-9))
+        return old, new, old_times, new_times
+
+    def describe_difference(self, old, new):
+        '''Return a one-line description of the first difference of old and new.'''
+        if old is None or new is None:
+            return 'failed: %s' % ('old' if old is None else 'new')
+        if old == new:
+            return 'same'
+        n = len(os.path.commonprefix([old, new]))
+        line = old[: n].count('\n') + 1
+        return 'differs at byte %s, line %s (%s/%s bytes)' % (n, line, len(old), len(new))
+
+    def load_version(self, spec, name):
+        '''
+        Load the py2cs.py given by spec as a module called name. spec is
+        either the path to a py2cs.py file or a git revision of py2cs.py.
+        '''
+        if os.path.isfile(spec):
+            fn = spec
+        else:
+            directory = os.path.dirname(os.path.abspath(py2cs.__file__))
+            source = subprocess.check_output(
+                ['git', 'show', '%s:./py2cs.py' % spec], cwd=directory)
+            f = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+            f.write(source)
+            f.close()
+            fn = f.name
+        if importlib_util:
+            module_spec = importlib_util.spec_from_file_location(name, fn)
+            module = importlib_util.module_from_spec(module_spec)
+            module_spec.loader.exec_module(module)
+        else:
+            module = imp.load_source(name, fn)
+        if fn != spec:
+            os.remove(fn)
+        return module
+
+    def run(self):
+        '''
+        Compare the output and the speed of the two versions for all files.
+        The self-conversion of py2cs.py is always the first file.
+        '''
+        golden = os.path.abspath(py2cs.__file__).replace('.pyc', '.py')
+        files = [golden] + [z for z in self.files if z != golden]
+        print('old: %s\nnew: %s' % (self.versions[0][0], self.versions[1][0]))
+        print('%-30s %8s %8s %8s   %-18s %s' % (
+            'file', 'old sec', 'new sec', 'ratio', '95% interval', 'output'))
+        all_ratios, n_differ = [], 0
+        for fn in files:
+            f = open(fn)
+            s = f.read()
+            f.close()
+            old, new, old_times, new_times = self.compare_file(fn, s)
+            ratios = [b / a for a, b in zip(old_times, new_times)]
+            status = self.describe_difference(old, new)
+            if status != 'same':
+                n_differ += 1
+            if old is None or new is None:
+                # The time of a failed conversion says nothing about speed.
+                print('%-30s %8.3f %8.3f %8s   %-16s   %s' % (
+                    os.path.basename(fn), min(old_times), min(new_times), '-', '-', status))
+                continue
+            ratio, low, high = confidence_interval(ratios)
+            all_ratios.append(ratio)
+            print('%-30s %8.3f %8.3f %7.3fx   [%6.3f, %6.3f]   %s' % (
+                os.path.basename(fn), min(old_times), min(new_times),
+                ratio, low, high, status))
+            if self.show_diffs and old != new:
+                for line in difflib.unified_diff(
+                    old.splitlines(True), new.splitlines(True), 'old', 'new'
+                ):
+                    sys.stdout.write(line)
+        if all_ratios:
+            ratio, low, high = confidence_interval(all_ratios)
+            print('%s files, %s differ, new/old time %.3fx [%.3f, %.3f]' % (
+                len(files), n_differ, ratio, low, high))
+        else:
+            print('%s files, %s differ' % (len(files), n_differ))
+        if n_differ:
+            self.exit_status = 1
+
+    def scan_command_line(self):
+        '''Set ivars from command-line arguments.'''
+        usage = "usage: py2cs_bench.py compare [options] OLD NEW file1, file2, ..."
+        parser = optparse.OptionParser(usage=usage)
+        parser.add_option('-d', '--diff', action='store_true', default=False,
+            help='show the differences of all differing outputs')
+        parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+            help='number of times to convert each file with each version')
+        options, args = parser.parse_args(sys.argv[2:])
+        if len(args) < 2:
+            parser.error('expected OLD and NEW')
+        self.repeat = max(1, options.repeat)
+        self.show_diffs = options.diff
+        for i, spec in enumerate(args[: 2]):
+            self.versions.append((spec, self.load_version(spec, 'py2cs_%s' % i)))
+        for z in args[2:]:
+            self.files.extend(glob.glob(os.path.abspath(os.path.expanduser(z))))
+
+if __name__ == "__main__":
+    main()
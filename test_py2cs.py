@@ -0,0 +1,811 @@
+#!/usr/bin/env python
+'''
+Tests for py2cs.py.
+
+Most tests convert test.py and py2cs.py itself in one of py2cs.py's modes
+and compare the result with a plain conversion. Run with:
+
+    python -m unittest test_py2cs
+'''
+import glob
+import io
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import py2cs
+import py2cs_bench
+
+directory = os.path.dirname(os.path.abspath(__file__))
+corpus = [os.path.join(directory, z) for z in ('test.py', 'py2cs.py')]
+
+
+class Py2csTestCase(unittest.TestCase):
+    '''The base class of all py2cs.py tests: a scratch directory and helpers.'''
+
+    def setUp(self):
+        '''Create the scratch directory and copy the corpus into it.'''
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.out = os.path.join(self.tmp, 'out')
+        os.mkdir(self.src)
+        os.mkdir(self.out)
+        self.files = []
+        for fn in corpus:
+            shutil.copy(fn, self.src)
+            self.files.append(os.path.join(self.src, os.path.basename(fn)))
+
+    def tearDown(self):
+        '''Remove the scratch directory.'''
+        shutil.rmtree(self.tmp)
+
+    def coffee_files(self, directory):
+        '''Return the sorted names of the .coffee files in directory.'''
+        return sorted([z for z in os.listdir(directory) if z.endswith('.coffee')])
+
+    def plain(self, fn):
+        '''Return the plain conversion of file fn.'''
+        return self.quietly(py2cs.MakeCoffeeScriptController().convert, fn, self.read(fn))
+
+    def quietly(self, f, *args):
+        '''Return f(*args), suppressing all output.'''
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if py2cs.isPython3 else io.BytesIO()
+        try:
+            return f(*args)
+        finally:
+            sys.stdout = stdout
+
+    def read(self, fn):
+        '''Return the contents of fn.'''
+        f = open(fn)
+        s = f.read()
+        f.close()
+        return s
+
+    def read_coffee(self, fn):
+        '''Return the contents of the .coffee file fn, without its time-stamp.'''
+        s = self.read(fn)
+        self.assertTrue(s.startswith('# python_to_coffeescript:'))
+        return s[s.find('\n') + 1:]
+
+    def run_py2cs(self, *args):
+        '''Run py2cs.py with the given command-line arguments. Return the controller.'''
+        argv = sys.argv
+        sys.argv = ['py2cs.py'] + list(args)
+        try:
+            controller = py2cs.MakeCoffeeScriptController()
+            self.quietly(controller.scan_command_line)
+            self.quietly(controller.scan_options)
+            self.quietly(controller.run)
+            return controller
+        finally:
+            sys.argv = argv
+
+    def assert_outputs_match_plain(self, out=None):
+        '''Assert that the .coffee file of each file in the corpus matches its plain conversion.'''
+        for fn in self.files:
+            name = os.path.basename(fn)[: -3] + '.coffee'
+            self.assertEqual(self.read_coffee(os.path.join(out or self.out, name)),
+                self.plain(fn), name)
+
+
+class TestModes(Py2csTestCase):
+    '''Every conversion mode produces the same output as a plain conversion.'''
+
+    def run_mode(self, *args):
+        '''Convert the corpus with the given arguments and compare the results.'''
+        controller = self.run_py2cs('-d', self.out, '-o', *(list(args) + self.files))
+        self.assertEqual(controller.exit_status, 0)
+        self.assert_outputs_match_plain()
+        return controller
+
+    def test_default(self):
+        self.run_mode()
+
+    def test_incremental(self):
+        self.run_mode('--incremental')
+        self.assertTrue(os.path.exists(os.path.join(self.out, '.py2cs-statements')))
+        # The second run reuses the cached output of every statement.
+        self.run_mode('--incremental')
+
+    def test_incremental_new_script(self):
+        '''A new version of py2cs.py ignores the statement cache.'''
+        self.run_mode('--incremental')
+        old, py2cs.script_sha1_value = py2cs.script_sha1(), 'new'
+        try:
+            controller = py2cs.MakeCoffeeScriptController()
+            controller.output_directory = self.out
+            controller.load_statement_cache()
+            self.assertEqual(controller.statement_cache, {})
+        finally:
+            py2cs.script_sha1_value = old
+
+    def test_jobs(self):
+        self.run_mode('-j', '2')
+
+    def test_io_threads(self):
+        self.run_mode('--io-threads', '2')
+
+    def test_threads(self):
+        self.run_mode('--threads', '3', '--io-threads', '1')
+
+    def test_budgets(self):
+        self.run_mode('--file-timeout', '60', '--file-max-rss', '1000',
+            '--max-source-size', '1000000')
+
+    def test_front_end_cache(self):
+        cache = os.path.join(self.tmp, 'cache')
+        self.run_mode('--front-end-cache', cache)
+        self.assertEqual(len(os.listdir(cache)), len(self.files))
+        # The second run reads the tokens from the cache.
+        controller = self.run_mode('--front-end-cache', cache, '--metrics',
+            os.path.join(self.tmp, 'metrics.prom'))
+        self.assertEqual(controller.metrics.counters.get(
+            ('cache_hits', (('cache', 'front_end'),))), len(self.files))
+
+    def test_front_end_cache_paths(self):
+        '''--only, --jobs and --explain also use the front-end cache.'''
+        for args in (['--only', 'spam'], ['--jobs', '2'], ['--explain', self.files[0]]):
+            cache = tempfile.mkdtemp(dir=self.tmp)
+            self.run_py2cs('-d', self.out, '-o', '--front-end-cache', cache, *(args + self.files))
+            self.assertNotEqual(os.listdir(cache), [], args)
+
+    def test_journal_and_resume(self):
+        self.run_mode()
+        controller = self.run_mode('--resume')
+        self.assertEqual(controller.n_resumed, len(self.files))
+
+    def test_log_and_metrics(self):
+        log_fn = os.path.join(self.tmp, 'log.jsonl')
+        metrics_fn = os.path.join(self.tmp, 'metrics.prom')
+        controller = self.run_mode('--log', log_fn, '--log-level', 'debug',
+            '--metrics', metrics_fn)
+        self.assertTrue(controller.log_file is sys.stderr) # The log is closed.
+        self.assertIn('"event": "converting"', self.read(log_fn))
+        self.assertIn('"event": "finished"', self.read(log_fn))
+        self.assertIn('py2cs_conversion_seconds_count %s' % len(self.files),
+            self.read(metrics_fn))
+
+    def test_profile(self):
+        '''--profile merges the statistics of all worker processes.'''
+        # Functions called only in the worker processes of each mode.
+        for option, name in (('--jobs=2', 'format_chunk'), ('--file-timeout=60', 'tokenize_source')):
+            fn = os.path.join(self.tmp, 'profile.pstats')
+            self.run_mode('--profile', fn, option)
+            names = [z[2] for z in py2cs.pstats.Stats(fn).stats]
+            self.assertIn(name, names)
+            self.assertEqual(glob.glob(fn + '.worker-*'), [])
+
+    def test_metrics_disabled(self):
+        '''Without --metrics, no metrics are collected.'''
+        controller = self.run_mode()
+        self.assertEqual(controller.metrics.counters, {})
+        self.assertEqual(controller.metrics.histograms, {})
+
+
+class TestPipeline(Py2csTestCase):
+    '''Tests of the --io-threads and --threads pipeline.'''
+
+    def test_same_output_file(self):
+        '''Of two inputs with the same .coffee file, only one is written.'''
+        os.mkdir(os.path.join(self.src, 'sub'))
+        fn = os.path.join(self.src, 'sub', 'test.py')
+        f = open(fn, 'w')
+        f.write('a = 1\n')
+        f.close()
+        controller = self.run_py2cs('-d', self.out, '--io-threads', '2', '--threads', '2',
+            '--metrics', os.path.join(self.tmp, 'metrics.prom'), self.files[0], fn)
+        self.assertEqual(controller.n_converted, 1)
+        self.assertEqual(controller.metrics.counters.get(
+            ('files_skipped', (('reason', 'file exists'),))), 1)
+
+    def test_thread_errors(self):
+        '''An exception in a converter or writer thread stops the pipeline.'''
+        n = py2cs.threading.active_count()
+        for name in ('convert_file', 'write_result'):
+            controller = py2cs.MakeCoffeeScriptController()
+            controller.output_directory = self.out
+            controller.files = self.files[: 1] * 100
+            controller.overwrite = True
+            controller.threads = 2
+
+            def fail(*args):
+                raise RuntimeError(name)
+
+            setattr(controller, name, fail)
+            self.assertRaises(RuntimeError, self.quietly, controller.run_pipeline)
+            self.assertEqual(py2cs.threading.active_count(), n)
+
+    def test_budget_workers(self):
+        '''Threads share the budget workers. Killed workers are not reused.'''
+        controller = self.run_py2cs('-d', self.out, '-o', '--threads', '2',
+            '--file-timeout', '60', *self.files)
+        self.assertEqual(controller.failures, [])
+        self.assert_outputs_match_plain()
+        self.assertEqual(controller.workers, [])
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.file_timeout = 0.001
+        s = self.read(self.files[1])
+        self.assertRaises(py2cs.ConversionFailure, controller.convert_with_budget,
+            self.files[1], s)
+        self.assertEqual(controller.workers, [])
+        controller.file_timeout = 60
+        self.assertEqual(controller.convert_with_budget(self.files[1], s),
+            self.plain(self.files[1]))
+        self.assertEqual(len(controller.workers), 1)
+        controller.stop_workers()
+
+    @unittest.skipUnless(hasattr(signal, 'SIGINT') and os.name == 'posix', 'needs SIGINT')
+    def test_worker_sync_warnings(self):
+        '''Sync warnings in worker processes are counted like those of a serial run.'''
+        key = 'sync_warnings', (('kind', 'unused strings'),)
+        metrics_fn = os.path.join(self.tmp, 'metrics.prom')
+        counts = []
+        for args in ([], ['-j', '2'], ['--file-timeout', '60']):
+            controller = self.run_py2cs(*(['-d', self.out, '-o', '--metrics', metrics_fn] +
+                args + [self.files[1]]))
+            counts.append(controller.metrics.counters.get(key))
+        self.assertTrue(counts[0])
+        self.assertEqual(counts, [counts[0]] * 3)
+
+    def test_interrupted(self):
+        '''A Ctrl-C in the main thread stops all threads of the pipeline.'''
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.output_directory = self.out
+        controller.files = self.files[: 1] * 100
+        controller.overwrite = True
+        n = py2cs.threading.active_count()
+
+        def convert_file(fn, out_fn, s):
+            os.kill(os.getpid(), signal.SIGINT)
+            py2cs.time.sleep(0.5)
+            return s
+
+        controller.convert_file = convert_file
+        self.assertRaises(KeyboardInterrupt, self.quietly, controller.run_pipeline)
+        self.assertEqual(py2cs.threading.active_count(), n)
+
+
+class TestConverter(Py2csTestCase):
+    '''Tests of the conversion of single files.'''
+
+    def test_jobs_chunks(self):
+        '''Chunks converted in worker processes join to the serial result.'''
+        fn = self.files[1]
+        s = self.read(fn)
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.jobs = 4
+        controller.min_chunk_lines = 50
+        self.assertTrue(len(controller.make_chunks(py2cs.ast.parse(s), s)) > 1)
+        controller.pool = multiprocessing.Pool(2)
+        try:
+            result = self.quietly(controller.convert, fn, s)
+        finally:
+            controller.pool.close()
+            controller.pool.join()
+        self.assertEqual(result, self.plain(fn))
+
+    def test_incremental_edit(self):
+        '''Editing one statement reconverts only that statement.'''
+        fn = self.files[0]
+        s = self.read(fn).replace('b = 2', 'b = 3')
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.incremental = True
+        controller.metrics.enabled = True
+        key = 'cache_misses', (('cache', 'statement'),)
+        self.quietly(controller.convert, fn, self.read(fn))
+        misses = controller.metrics.counters[key]
+        result = self.quietly(controller.convert, fn, s)
+        self.assertEqual(result, self.quietly(
+            py2cs.MakeCoffeeScriptController().convert, fn, s))
+        self.assertEqual(controller.metrics.counters[key], misses + 1)
+
+    def test_only(self):
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.only = ['spam']
+        result = self.quietly(controller.convert, self.files[0], self.read(self.files[0]))
+        self.assertIn('spam', result)
+        self.assertNotIn('TestClass', result)
+
+    def test_only_not_found(self):
+        '''A file that does not define every --only name fails, and nothing is written.'''
+        controller = self.run_py2cs('-d', self.out, '--only', 'spam,eggs', self.files[0])
+        self.assertEqual(controller.exit_status, 1)
+        self.assertEqual([z['error'] for z in controller.failures], ['not found: eggs'])
+        self.assertEqual(self.coffee_files(self.out), [])
+
+    def test_strip_comments(self):
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.strip_comments = True
+        fn = self.files[1]
+        result = self.quietly(controller.convert, fn, self.read(fn))
+        self.assertNotIn('# Ivars for', result)
+        self.assertIn('# Ivars for', self.plain(fn))
+
+    def test_max_source_size(self):
+        '''--max-source-size limits the size of the file in bytes, not characters.'''
+        fn = os.path.join(self.src, 'wide.py')
+        f = io.open(fn, 'w', encoding='utf-8')
+        f.write(u'a = "\u00e9\u00e9\u00e9\u00e9"\n')
+        f.close()
+        controller = self.run_py2cs('-d', self.out, '--max-source-size', '12', fn)
+        self.assertEqual([z['error'] for z in controller.failures],
+            ['source too large: 15 bytes'])
+
+    def test_budgets_without_worker_options(self):
+        '''The budget worker does not support --incremental or --jobs.'''
+        for option in ('--incremental', '--jobs=2'):
+            self.assertRaises(SystemExit, self.run_py2cs, '-d', self.out,
+                '--file-timeout', '60', option, self.files[0])
+
+    def test_global_and_continue(self):
+        '''global and continue statements keep their leading comments.'''
+        s = 'def f():\n    # Comment 1.\n    global a\n    for b in c:\n' \
+            '        # Comment 2.\n        continue\n'
+        controller = py2cs.MakeCoffeeScriptController()
+        result = self.quietly(controller.convert, 'test.py', s)
+        self.assertIn('# Comment 1.\n    global a\n', result)
+        self.assertIn('# Comment 2.\n        continue\n', result)
+
+    def test_self_conversion(self):
+        '''py2cs.py converts itself without failures.'''
+        controller = self.run_py2cs('-d', self.out, '-o', self.files[1])
+        self.assertEqual(controller.failures, [])
+
+
+class TestInputsAndOutputs(Py2csTestCase):
+    '''Tests of the input and output formats.'''
+
+    def test_output_archive(self):
+        fn = os.path.join(self.tmp, 'out.zip')
+        self.run_py2cs('-d', self.out, '--output-archive', fn, *self.files)
+        archive = zipfile.ZipFile(fn)
+        for z in self.files:
+            name = os.path.basename(z)[: -3] + '.coffee'
+            s = archive.read(name).decode('utf-8')
+            self.assertEqual(s[s.find('\n') + 1:], self.plain(z))
+        archive.close()
+
+    def test_output_archive_incremental(self):
+        '''--incremental copies the entries of unchanged files from the previous archive.'''
+        fn = os.path.join(self.tmp, 'out.zip')
+        self.run_py2cs('-d', self.out, '--output-archive', fn, *self.files)
+        metrics_fn = os.path.join(self.tmp, 'metrics.prom')
+        controller = self.run_py2cs('-d', self.out, '--incremental', '--output-archive', fn,
+            '--metrics', metrics_fn, *self.files)
+        self.assertEqual(controller.exit_status, 0)
+        self.assertEqual(controller.metrics.counters.get(
+            ('cache_hits', (('cache', 'archive'),))), len(self.files))
+        archive = zipfile.ZipFile(fn)
+        for z in self.files:
+            name = os.path.basename(z)[: -3] + '.coffee'
+            s = archive.read(name).decode('utf-8')
+            self.assertEqual(s[s.find('\n') + 1:], self.plain(z))
+        archive.close()
+
+    def test_archive_input(self):
+        fn = os.path.join(self.tmp, 'in.zip')
+        archive = zipfile.ZipFile(fn, 'w')
+        for z in self.files:
+            archive.write(z, 'pkg/' + os.path.basename(z))
+        archive.close()
+        self.run_py2cs('-d', self.out, fn)
+        self.assert_outputs_match_plain(os.path.join(self.out, 'pkg'))
+
+    def test_tar_input(self):
+        '''Tar files are read as a stream.'''
+        fn = os.path.join(self.tmp, 'in.tar.gz')
+        archive = tarfile.open(fn, 'w:gz')
+        for z in self.files:
+            archive.add(z, 'pkg/' + os.path.basename(z))
+        archive.close()
+        modes, open_tar = [], tarfile.open
+        def open_(name, mode='r', *args, **kwargs):
+            modes.append(mode)
+            return open_tar(name, mode, *args, **kwargs)
+        tarfile.open = open_
+        try:
+            self.run_py2cs('-d', self.out, fn)
+        finally:
+            tarfile.open = open_tar
+        self.assertEqual(modes, ['r|*'])
+        self.assert_outputs_match_plain(os.path.join(self.out, 'pkg'))
+
+    def test_archive_input_resume(self):
+        '''--resume skips the archive members completed by the previous run.'''
+        fn = os.path.join(self.tmp, 'in.zip')
+        archive = zipfile.ZipFile(fn, 'w')
+        for z in self.files:
+            archive.write(z, 'pkg/' + os.path.basename(z))
+        archive.close()
+        self.run_py2cs('-d', self.out, fn)
+        controller = self.run_py2cs('-d', self.out, '--resume', fn)
+        self.assertEqual((controller.n_resumed, controller.n_converted), (2, 0))
+        os.utime(fn, (0, 0))
+        controller = self.run_py2cs('-d', self.out, '-o', '--resume', fn)
+        self.assertEqual((controller.n_resumed, controller.n_converted), (0, 2))
+
+    def test_leo_clean(self):
+        '''The @clean py2cs.py tree of py2cs.leo reassembles to py2cs.py.'''
+        controller = py2cs.MakeCoffeeScriptController()
+        nodes, roots, bodies = controller.parse_leo_file(os.path.join(directory, 'py2cs.leo'))
+        gnx = [z[0] for z in roots if z[1:] == ('clean', 'py2cs.py')][0]
+        lines = []
+        controller.put_leo_body(gnx, '', nodes, bodies, lines)
+        self.assertEqual(''.join(lines), self.read(corpus[1]))
+
+    def test_leo_file(self):
+        '''@file trees are read from their python files, relative to @path directives.'''
+        os.mkdir(os.path.join(self.src, 'sub'))
+        f = open(os.path.join(self.src, 'sub', 'mod.py'), 'w')
+        f.write('#@+leo-ver=5-thin\n#@+node:t.2: * @file mod.py\n#@@language python\n'
+            'def spam():\n    #@verbatim\n    #@ A comment.\n    return 1\n#@-leo\n')
+        f.close()
+        fn = os.path.join(self.src, 'test.leo')
+        f = open(fn, 'w')
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<leo_file>\n<vnodes>\n'
+            '<v t="t.1"><vh>@path sub</vh>\n<v t="t.2"><vh>@file mod.py</vh></v>\n</v>\n'
+            '<v t="t.3"><vh>@file missing.py</vh></v>\n</vnodes>\n'
+            '<tnodes>\n<t tx="t.1"></t>\n</tnodes>\n</leo_file>\n')
+        f.close()
+        controller = self.run_py2cs('-d', self.out, fn)
+        self.assertEqual(controller.exit_status, 1)
+        self.assertEqual([z['input'] for z in controller.failures],
+            [os.path.join(self.src, 'missing.py')])
+        controller = py2cs.MakeCoffeeScriptController()
+        expected = self.quietly(controller.convert, 'mod.py',
+            'def spam():\n    #@ A comment.\n    return 1\n')
+        self.assertEqual(self.read_coffee(os.path.join(self.out, 'mod.coffee')), expected)
+
+    def test_bundle(self):
+        controller = self.run_py2cs('-d', self.out, '--bundle-by', 'directory', *self.files)
+        self.assertEqual(controller.exit_status, 0)
+        s = self.read_coffee(os.path.join(self.out, 'src.coffee'))
+        for fn in self.files:
+            self.assertIn(self.plain(fn), s)
+
+    def test_bundle_unchanged(self):
+        '''Bundles whose files have not changed are not written again.'''
+        self.run_py2cs('-d', self.out, '--bundle-by', 'directory', *self.files)
+        fn = os.path.join(self.out, 'src.coffee')
+        mtime = os.path.getmtime(fn)
+        controller = self.run_py2cs('-d', self.out, '-o', '--bundle-by', 'directory',
+            '--metrics', os.path.join(self.tmp, 'metrics.prom'), *self.files)
+        self.assertEqual(controller.metrics.counters.get(
+            ('files_skipped', (('reason', 'unchanged'),))), 1)
+        self.assertEqual(os.path.getmtime(fn), mtime)
+
+    def test_bundle_resume(self):
+        '''--resume converts a bundle whole unless the journal completed all its files.'''
+        a, b = os.path.join(self.src, 'a.py'), os.path.join(self.src, 'b.py')
+        for fn, s in ((a, 'a = 1\n'), (b, 'b = 2\n')):
+            f = open(fn, 'w')
+            f.write(s)
+            f.close()
+        # The journal contains only a.py.
+        self.run_py2cs('-d', self.out, '--bundle-by', 'directory', a)
+        f = open(b, 'w')
+        f.write('b = 3\n')
+        f.close()
+        args = '-d', self.out, '-o', '--bundle-by', 'directory', '--resume', a, b
+        controller = self.run_py2cs(*args)
+        self.assertEqual((controller.n_resumed, controller.n_converted), (0, 2))
+        s = self.read_coffee(os.path.join(self.out, 'src.coffee'))
+        self.assertIn(self.plain(a), s)
+        self.assertIn(self.plain(b), s)
+        # Without the bundle cache, the journal shows that the bundle is complete.
+        os.remove(os.path.join(self.out, '.py2cs-bundles'))
+        controller = self.run_py2cs(*args)
+        self.assertEqual((controller.n_resumed, controller.n_converted), (2, 0))
+
+    def test_bundle_shard(self):
+        self.assertRaises(SystemExit, self.run_py2cs, '-d', self.out,
+            '--bundle-by', 'directory', '--shard', '1/2', *self.files)
+
+    def test_explain(self):
+        stdout = sys.stdout
+        sys.stdout = buf = io.StringIO() if py2cs.isPython3 else io.BytesIO()
+        try:
+            py2cs.MakeCoffeeScriptController().explain_file(self.files[0])
+        finally:
+            sys.stdout = stdout
+        self.assertIn('explain: %s' % self.files[0], buf.getvalue())
+
+    def test_explain_counts(self):
+        '''The Explainer counts the TokenSync calls of every statement.'''
+        explainer = py2cs.Explainer(py2cs.MakeCoffeeScriptController())
+        self.quietly(explainer.explain, 'test.py', 'a = 1\nb = 2 # Comment.\n')
+        self.assertEqual(len(explainer.regions), 2)
+        for d in explainer.regions:
+            self.assertEqual(d['calls'].get('leading_lines'), 1)
+            self.assertEqual(d['calls'].get('trailing_comment_at_lineno'), 1)
+
+
+class TestCheck(Py2csTestCase):
+    '''Tests of --check.'''
+
+    def snapshot(self):
+        '''Return the names and modification times of all files in the output directory.'''
+        result = []
+        for root, dirs, files in os.walk(self.out):
+            for name in dirs + files:
+                fn = os.path.join(root, name)
+                result.append((fn, os.path.getmtime(fn)))
+        return sorted(result)
+
+    def test_check_writes_nothing(self):
+        '''--check leaves the output directory unchanged, with any options.'''
+        self.run_py2cs('-d', self.out, *self.files)
+        fn = os.path.join(self.tmp, 'in.zip')
+        archive = zipfile.ZipFile(fn, 'w')
+        archive.write(self.files[0], 'pkg/test.py')
+        archive.close()
+        before = self.snapshot()
+        controller = self.run_py2cs('-d', self.out, '--check', '--incremental', *self.files)
+        self.assertEqual(controller.exit_status, 0)
+        self.run_py2cs('-d', self.out, '--check', fn)
+        self.assertEqual(self.snapshot(), before)
+
+    def test_check_cache(self):
+        '''With --front-end-cache, --check does not convert unchanged files again.'''
+        self.run_py2cs('-d', self.out, *self.files)
+        cache = os.path.join(self.tmp, 'cache')
+        metrics_fn = os.path.join(self.tmp, 'metrics.prom')
+        for i in range(2):
+            controller = self.run_py2cs('-d', self.out, '--check', '--front-end-cache', cache,
+                '--metrics', metrics_fn, *self.files)
+            self.assertEqual(controller.exit_status, 0)
+        self.assertEqual(controller.metrics.counters.get(
+            ('cache_hits', (('cache', 'check'),))), len(self.files))
+
+    def test_check_cache_new_script(self):
+        '''A new version of py2cs.py converts all files again.'''
+        self.run_py2cs('-d', self.out, *self.files)
+        cache = os.path.join(self.tmp, 'cache')
+        self.run_py2cs('-d', self.out, '--check', '--front-end-cache', cache, *self.files)
+        old, py2cs.script_sha1_value = py2cs.script_sha1(), 'new'
+        try:
+            controller = self.run_py2cs('-d', self.out, '--check', '--front-end-cache', cache,
+                '--metrics', os.path.join(self.tmp, 'metrics.prom'), *self.files)
+        finally:
+            py2cs.script_sha1_value = old
+        self.assertEqual(controller.metrics.counters.get(('cache_hits', (('cache', 'check'),))), None)
+
+
+class TestCompare(Py2csTestCase):
+    '''Tests of 'py2cs_bench.py compare'.'''
+
+    def test_compare(self):
+        '''Identical versions give identical outputs; failed conversions have no time ratio.'''
+        bad_fn = os.path.join(self.src, 'bad.py')
+        f = open(bad_fn, 'w')
+        f.write('def (\n')
+        f.close()
+        comparison = py2cs_bench.Comparison()
+        comparison.repeat = 1
+        comparison.files = [self.files[0], bad_fn]
+        for i in range(2):
+            comparison.versions.append(
+                ('v%s' % i, comparison.load_version(self.files[1], 'py2cs_%s' % i)))
+        stdout = sys.stdout
+        sys.stdout = buf = io.StringIO() if py2cs.isPython3 else io.BytesIO()
+        try:
+            comparison.run()
+        finally:
+            sys.stdout = stdout
+        rows = dict([(z.split()[0], z.split()) for z in buf.getvalue().splitlines()])
+        self.assertEqual(rows['test.py'][-1], 'same')
+        self.assertEqual(rows['bad.py'][3:], ['-', '-', 'failed:', 'old'])
+        # Only py2cs.py and test.py contribute to the summary.
+        self.assertTrue(buf.getvalue().splitlines()[-1].startswith(
+            '3 files, 1 differ, new/old time'))
+        self.assertEqual(comparison.exit_status, 1)
+
+
+class TestSharding(Py2csTestCase):
+    '''Tests of --shard and --merge-manifests.'''
+
+    def test_partition(self):
+        '''The shards are disjoint and cover all files.'''
+        for i in range(10):
+            f = open(os.path.join(self.src, 'f%s.py' % i), 'w')
+            f.write('a = 1\n' * (i * 7 % 10 + 1))
+            f.close()
+        files = sorted(glob.glob(os.path.join(self.src, '*.py')))
+        controller = py2cs.MakeCoffeeScriptController()
+        controller.input_directory = self.src
+        shards = []
+        for i in range(3):
+            controller.shard = i, 3
+            shards.append(controller.shard_files(files))
+        self.assertEqual(sorted(sum(shards, [])), files)
+        self.assertTrue(all(shards))
+
+    def test_bad_shard(self):
+        '''--shard rejects indices outside 1..COUNT.'''
+        for shard in ('0/3', '4/3', '1/0', '-1/3', 'x', '1/2/3'):
+            self.assertRaises(SystemExit, self.run_py2cs, '-d', self.out, '--shard', shard,
+                self.files[0])
+        self.assertEqual(self.coffee_files(self.out), [])
+
+    def test_merge_manifests(self):
+        for i in (1, 2):
+            self.run_py2cs('-d', self.out, '-o', '--shard', '%s/2' % i, *self.files)
+        manifests = sorted(glob.glob(os.path.join(self.out, 'py2cs-manifest-*.json')))
+        self.assertEqual(len(manifests), 2)
+        controller = self.run_py2cs('--merge-manifests', *manifests)
+        self.assertEqual(controller.exit_status, 0)
+        self.assert_outputs_match_plain()
+
+
+class TestJobs(Py2csTestCase):
+    '''Tests of the [Job NAME] sections of configuration files.'''
+
+    def test_jobs(self):
+        out2 = os.path.join(self.tmp, 'out2')
+        os.mkdir(out2)
+        fn = os.path.join(self.tmp, 'py2cs.cfg')
+        f = open(fn, 'w')
+        f.write('[Global]\noutput_directory: %s\n\n' % self.out)
+        f.write('[Job first]\nfiles: %s\n\n' % self.files[0])
+        f.write('[Job second]\nfiles: %s\noutput_directory: %s\n' % (self.files[1], out2))
+        f.close()
+        controller = self.run_py2cs('-c', fn)
+        self.assertEqual(controller.exit_status, 0)
+        self.assertEqual(controller.n_converted, 2)
+        self.assertEqual(self.coffee_files(self.out), ['test.coffee'])
+        self.assertEqual(self.read_coffee(os.path.join(out2, 'py2cs.coffee')),
+            self.plain(self.files[1]))
+
+    def test_jobs_budget_workers(self):
+        '''Jobs share the budget workers, which use the options of each job.'''
+        out2 = os.path.join(self.tmp, 'out2')
+        os.mkdir(out2)
+        fn = os.path.join(self.tmp, 'py2cs.cfg')
+        f = open(fn, 'w')
+        f.write('[Global]\nfiles: %s\noutput_directory: %s\n\n' % (self.files[1], self.out))
+        f.write('[Job first]\nstrip_comments: yes\n\n')
+        f.write('[Job second]\noutput_directory: %s\n' % out2)
+        f.close()
+        started, start_worker = [], py2cs.MakeCoffeeScriptController.start_worker
+        def start(controller):
+            started.append(controller)
+            return start_worker(controller)
+        py2cs.MakeCoffeeScriptController.start_worker = start
+        try:
+            controller = self.run_py2cs('-c', fn, '--file-timeout', '60')
+        finally:
+            py2cs.MakeCoffeeScriptController.start_worker = start_worker
+        self.assertEqual(controller.exit_status, 0)
+        self.assertEqual(len(started), 1)
+        self.assertEqual(controller.workers, [])
+        self.assertNotIn('# Ivars for', self.read_coffee(os.path.join(self.out, 'py2cs.coffee')))
+        self.assertEqual(self.read_coffee(os.path.join(out2, 'py2cs.coffee')),
+            self.plain(self.files[1]))
+
+    def test_jobs_resume(self):
+        '''Jobs sharing an output directory keep separate journals.'''
+        fn = os.path.join(self.tmp, 'py2cs.cfg')
+        f = open(fn, 'w')
+        f.write('[Global]\noutput_directory: %s\n\n' % self.out)
+        f.write('[Job first]\nfiles: %s\n\n' % self.files[0])
+        f.write('[Job second]\nfiles: %s\n' % self.files[1])
+        f.close()
+        self.run_py2cs('-c', fn)
+        controller = self.run_py2cs('-c', fn, '--resume')
+        self.assertEqual(controller.n_resumed, 2)
+
+
+class GitTestCase(Py2csTestCase):
+    '''The base class of tests that need a git repository.'''
+
+    def setUp(self):
+        '''Make the source directory a git repository.'''
+        Py2csTestCase.setUp(self)
+        self.cwd = os.getcwd()
+        os.chdir(self.src)
+        try:
+            self.git('init', '-q')
+        except (OSError, subprocess.CalledProcessError):
+            os.chdir(self.cwd)
+            Py2csTestCase.tearDown(self)
+            raise unittest.SkipTest('git is not available')
+        self.commit()
+
+    def tearDown(self):
+        '''Leave the git repository.'''
+        os.chdir(self.cwd)
+        Py2csTestCase.tearDown(self)
+
+    def commit(self):
+        '''Commit all files in the source directory.'''
+        self.git('add', '-A')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+            'commit', '-q', '-m', 'test')
+
+    def git(self, *args):
+        '''Run git in the source directory.'''
+        subprocess.check_call(('git',) + args, stdout=open(os.devnull, 'w'))
+
+
+class TestGit(GitTestCase):
+    '''Tests of --since and --git-rev.'''
+
+    def test_since_rename(self):
+        self.run_py2cs('-d', self.out, self.files[0])
+        self.git('mv', 'test.py', 'test2.py')
+        self.commit()
+        self.run_py2cs('-d', self.out, '--since', 'HEAD~1')
+        self.assertEqual(self.coffee_files(self.out), ['test2.coffee'])
+
+    def test_since_rename_unmatched(self):
+        '''Renaming a file to a name that does not match removes its output.'''
+        self.run_py2cs('-d', self.out, self.files[0])
+        self.git('mv', 'test.py', 'test.txt')
+        self.commit()
+        self.run_py2cs('-d', self.out, '--since', 'HEAD~1')
+        self.assertEqual(self.coffee_files(self.out), [])
+
+    def test_since_uncommitted(self):
+        '''Uncommitted changes since the revision count as changes.'''
+        f = open(self.files[0], 'a')
+        f.write('a = 1\n')
+        f.close()
+        self.run_py2cs('-d', self.out, '--since', 'HEAD')
+        self.assertEqual(self.coffee_files(self.out), ['test.coffee'])
+
+    def test_git_rev(self):
+        for fn in self.files:
+            os.remove(fn)
+        controller = self.run_py2cs('-d', self.out, '--git-rev', 'HEAD')
+        self.assertEqual(controller.exit_status, 0)
+        for fn in corpus:
+            name = os.path.basename(fn)[: -3] + '.coffee'
+            self.assertEqual(self.read_coffee(os.path.join(self.out, name)), self.plain(fn))
+
+    def test_git_rev_cache(self):
+        '''--git-rev caches blobs in the output directory, also for files in directories.'''
+        os.mkdir('sub')
+        shutil.copy(self.files[0], os.path.join('sub', 'module.py'))
+        self.commit()
+        controller = self.run_py2cs('-d', self.out, '--git-rev', 'HEAD')
+        self.assertEqual(controller.exit_status, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out, 'module.coffee')))
+        self.assertTrue(os.path.exists(os.path.join(self.out, '.py2cs-blobs')))
+        self.assertEqual(glob.glob('HEAD*'), [])
+
+    def test_git_rev_cache_hit(self):
+        '''A file that is unchanged in the next revision is not converted again.'''
+        self.run_py2cs('-d', self.out, '--git-rev', 'HEAD')
+        f = open(self.files[0], 'a')
+        f.write('a = 1\n')
+        f.close()
+        self.commit()
+        metrics_fn = os.path.join(self.tmp, 'metrics.prom')
+        controller = self.run_py2cs('-d', self.out, '-o', '--git-rev', 'HEAD',
+            '--metrics', metrics_fn)
+        counters = controller.metrics.counters
+        self.assertEqual(counters.get(('cache_hits', (('cache', 'blob'),))), 1)
+        self.assertEqual(counters.get(('cache_misses', (('cache', 'blob'),))), 1)
+        self.assertIn('a=1', self.read_coffee(os.path.join(self.out, 'test.coffee')))
+
+    def test_git_rev_config_paths(self):
+        '''With --git-rev, the files of a configuration file need not exist in the working tree.'''
+        os.remove(self.files[0])
+        fn = os.path.join(self.tmp, 'py2cs.cfg')
+        f = open(fn, 'w')
+        f.write('[Global]\nfiles: %s\noutput_directory: %s\n' % (self.files[0], self.out))
+        f.close()
+        controller = self.run_py2cs('-c', fn, '--git-rev', 'HEAD')
+        self.assertEqual(controller.exit_status, 0)
+        self.assertEqual(self.coffee_files(self.out), ['test.coffee'])
+
+if __name__ == '__main__':
+    unittest.main()